@@ -1,30 +1,73 @@
 import json
 import os
 import re
+import threading
 import io
 import csv
-from datetime import datetime, timedelta,timezone
+import base64
+import hashlib
+import uuid
+import time
+import tempfile
+import zipfile
+import unicodedata
+from datetime import datetime, timedelta,timezone, date
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 try:
     from zoneinfo import ZoneInfo
 except ImportError:
     ZoneInfo = None
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess as prometheus_multiprocess
+except ImportError:
+    prometheus_client = prometheus_multiprocess = None
+
 from functools import wraps
 
+import click
+
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    send_from_directory, session, flash, Response
+    send_from_directory, session, flash, Response, jsonify,
+    stream_with_context, g, has_app_context, has_request_context, make_response,
+    before_render_template, template_rendered
 )
+from flask.cli import AppGroup
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from sqlalchemy import (
-    create_engine, Table, Column, Integer, String,
-    MetaData, ForeignKey, text, inspect
+    event,
+    create_engine, Table, Column, Integer, String, Float,
+    MetaData, ForeignKey, Index, UniqueConstraint,
+    text, inspect, select, func, case, true, or_, null, bindparam
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, NoSuchTableError
 
 # ----------------------------
 #       SQLALCHEMY MODELS
@@ -38,6 +81,11 @@ class Wardrobe(BaseMaster):
     id = Column(Integer, primary_key=True)
     nome = Column(String, unique=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    # created_at dell'ultimo capo aggiunto (copia per l'header, vedi
+    # aggiorna_ultimo_inserimento): evita di interrogare i capi a ogni pagina
+    last_added_at = Column(String)
+    # incrementata a ogni modifica dei capi (ETag delle pagine del wardrobe)
+    versione = Column(Integer, nullable=False, default=0, server_default='0')
 
 
 class User(BaseMaster):
@@ -48,6 +96,158 @@ class User(BaseMaster):
     password_hash = Column(String, nullable=False)
 
 
+class Capo(BaseMaster):
+    """
+    Tabella unica dei capi (storage 'condiviso'): tutti i wardrobe in una
+    sola tabella, distinti da wardrobe_id. `legacy_id` è l'id della riga
+    nella vecchia tabella wardrobe_<username> (serve alla migrazione).
+    """
+    __tablename__ = 'capi'
+    id = Column(Integer, primary_key=True)
+    wardrobe_id = Column(Integer, ForeignKey('wardrobes.id'), nullable=False)
+    categoria = Column(String)
+    tipologia = Column(String)
+    taglia = Column(String)
+    fit = Column(String)
+    colore = Column(String)
+    brand = Column(String)
+    destinazione = Column(String)
+    immagine = Column(String)
+    immagine2 = Column(String)
+    created_at = Column(String)
+    # pezzi di questo capo: una riga per capo distinto, non una per pezzo
+    quantita = Column(Integer, nullable=False, default=1, server_default='1')
+    legacy_id = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_capi_wardrobe_created', 'wardrobe_id', 'created_at'),
+        Index('ix_capi_facette', 'categoria', 'taglia', 'brand', 'destinazione', 'colore'),
+        UniqueConstraint('wardrobe_id', 'legacy_id', name='uq_capi_wardrobe_legacy'),
+    )
+
+
+class ImmagineFile(BaseMaster):
+    """
+    Registro delle immagini caricate: ogni file è salvato una sola volta con
+    nome <sha256>.<ext> (indirizzato per contenuto), qualunque sia il nome
+    del file originale e quante volte venga caricato.
+    """
+    __tablename__ = 'immagini_file'
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), unique=True, nullable=False)
+    nome = Column(String, unique=True, nullable=False)
+    dimensione = Column(Integer)
+    nome_originale = Column(String)
+    created_at = Column(String)
+    # ultimo upload dello stesso contenuto (deduplicato sul file esistente)
+    usato_at = Column(String)
+    # capi che la referenziano all'ultimo `flask gc-immagini` (non aggiornato
+    # dalle route: il gc riconta sempre, i capi nuovi li copre usato_at)
+    riferimenti = Column(Integer)
+    contati_at = Column(String)
+
+
+class CatalogoCapo(BaseMaster):
+    """
+    Catalogo pubblico materializzato: una riga per ogni gruppo di capi uguali
+    (stessa CHIAVE_CATALOGO), con il numero di pezzi in `disponibilita`.
+    Aggiornato in modo incrementale dalle route che scrivono sui wardrobe.
+    """
+    __tablename__ = 'catalogo_pubblico'
+    id = Column(Integer, primary_key=True)
+    chiave = Column(String(40), unique=True, nullable=False)
+    categoria = Column(String)
+    tipologia = Column(String)
+    taglia = Column(String)
+    fit = Column(String)
+    colore = Column(String)
+    brand = Column(String)
+    destinazione = Column(String)
+    immagine = Column(String)
+    immagine2 = Column(String)
+    disponibilita = Column(Integer, nullable=False, default=0)
+    created_at = Column(String, index=True)
+    # versione del catalogo all'ultima modifica della voce: le voci esaurite
+    # restano con disponibilita 0 così chi tiene una copia del catalogo
+    # (IndiceFacette) può aggiornarsi leggendo solo le voci cambiate
+    versione = Column(Integer, nullable=False, default=0, index=True)
+
+
+class CatalogoVersione(BaseMaster):
+    """
+    Contatore (riga unica, id=1) delle modifiche al catalogo pubblico.
+    `versione` cresce a ogni modifica, `ricostruzione` a ogni rebuild completo.
+    """
+    __tablename__ = 'catalogo_versione'
+    id = Column(Integer, primary_key=True)
+    versione = Column(Integer, nullable=False, default=0)
+    ricostruzione = Column(Integer, nullable=False, default=0)
+
+
+class Prenotazione(BaseMaster):
+    """
+    Noleggio di `quantita` pezzi di una voce del catalogo pubblico dal giorno
+    `inizio` al giorno `fine` compresi (date ISO YYYY-MM-DD). La voce è
+    identificata dalla sua `chiave`, che sopravvive ai rebuild del catalogo.
+    """
+    __tablename__ = 'prenotazioni'
+    id = Column(Integer, primary_key=True)
+    chiave = Column(String(40), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    quantita = Column(Integer, nullable=False)
+    inizio = Column(String(10), nullable=False)
+    fine = Column(String(10), nullable=False)
+    stato = Column(String, nullable=False, default='attiva')
+    created_at = Column(String)
+
+    __table_args__ = (
+        # indice per intervalli: prenotazioni di una voce che finiscono dopo D1
+        # (e iniziano entro D2), senza leggere quelle delle altre voci
+        Index('ix_prenotazioni_intervallo', 'chiave', 'fine', 'inizio'),
+        Index('ix_prenotazioni_utente', 'user_id'),
+    )
+
+
+class SchemaVersione(BaseMaster):
+    """Versione dello schema (riga unica, id=1): l'ultima migrazione applicata."""
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    versione = Column(Integer, nullable=False)
+    aggiornato = Column(String)
+
+
+class LoginLimite(BaseMaster):
+    """
+    Token bucket dei tentativi di login, uno per chiave ('ip:<indirizzo>' o
+    'account:<user_id>'). Sta nel DB così è condiviso tra i worker.
+    """
+    __tablename__ = 'login_limiti'
+    chiave = Column(String, primary_key=True)
+    gettoni = Column(Float, nullable=False)
+    aggiornato = Column(Float, nullable=False, index=True)
+
+
+class Lavoro(BaseMaster):
+    """
+    Coda dei lavori in background (es. derivati di un'immagine caricata).
+    `stato`: in_coda -> in_corso -> (riga eliminata) oppure errore.
+    """
+    __tablename__ = 'lavori'
+    id = Column(Integer, primary_key=True)
+    tipo = Column(String, nullable=False)
+    argomenti = Column(String, nullable=False)  # JSON
+    stato = Column(String, nullable=False, default='in_coda')
+    tentativi = Column(Integer, nullable=False, default=0)
+    esegui_dopo = Column(Float, nullable=False, default=0)
+    aggiornato = Column(Float, nullable=False, default=0)
+    errore = Column(String)
+    created_at = Column(String)
+
+    __table_args__ = (
+        Index('ix_lavori_stato', 'stato', 'esegui_dopo'),
+    )
+
+
 # ----------------------------
 #       FLASK CONFIG
 # ----------------------------
@@ -55,74 +255,1500 @@ class User(BaseMaster):
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 
+# dietro un reverse proxy request.remote_addr è l'IP del proxy (uguale per
+# tutti i client: il limite di login per IP diventerebbe globale).
+# PROXY_HOPS = quanti proxy fidati aggiungono X-Forwarded-For; con 0 l'header
+# è ignorato, perché chiunque può scriverlo. Su Render (RENDER=true) è 1.
+PROXY_HOPS = int(os.environ.get("PROXY_HOPS", "1" if os.environ.get("RENDER") else "0"))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
 # cartella immagini (assoluta)
 BASE_DIR = os.path.dirname(__file__)
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'immagini')
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10 MB
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
 
+# derivati delle immagini (thumbnail ridimensionate, JPEG + WebP)
+# salvati in immagini/_derivati come <nome>__w<larghezza>.<jpg|webp>
+CARTELLA_DERIVATI = '_derivati'
+LARGHEZZE_DERIVATI = (320, 640, 1280)
+
+# file indirizzati per contenuto (<sha256>.<ext> e i loro derivati): non
+# cambiano mai, quindi si possono mettere in cache per sempre
+NOME_PER_CONTENUTO = re.compile(r'^[0-9a-f]{64}(__w\d+)?\.[a-z0-9]+$')
+CACHE_IMMUTABILE = 365 * 24 * 3600
+CACHE_IMMAGINI_LEGACY = 3600
+
 # timeout sessione (in minuti)
 SESSION_TIMEOUT_MINUTES = 60
 
 # DB: usa DATABASE_URL se presente (es. Postgres su Render), altrimenti SQLite locale
 DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///guardaroba.db")
-engine = create_engine(DATABASE_URL)
+
+
+def _opzioni_pool(url: str) -> dict:
+    """
+    Parametri del pool di connessioni, configurabili da ambiente:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (secondi),
+    DB_POOL_RECYCLE (secondi, -1 = mai), DB_POOL_PRE_PING (1/0).
+    """
+    opzioni = {
+        'pool_pre_ping': os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+        'pool_recycle': int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    }
+    url = make_url(url)
+    # SQLite in memoria usa un pool a connessione singola, senza dimensioni
+    if not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+        opzioni.update(
+            pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        )
+    return opzioni
+
+
+engine = create_engine(DATABASE_URL, **_opzioni_pool(DATABASE_URL))
+
+# gunicorn (e il ProcessPoolExecutor di genera-derivati) fanno fork dopo
+# l'import: il figlio non deve riusare le connessioni aperte dal padre,
+# quindi ne abbandona il pool (senza chiuderle, restano del padre)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+# Dove stanno i capi:
+# - "per_utente": una tabella fisica wardrobe_<username> per ogni utente (storico)
+# - "condiviso":  tabella unica `capi` con wardrobe_id (dopo `flask migra-capi`)
+WARDROBE_STORAGE = os.environ.get("WARDROBE_STORAGE", "per_utente")
+STORAGE_CONDIVISO = WARDROBE_STORAGE == "condiviso"
+
+# campi che identificano i "capi uguali" nel catalogo pubblico
+CHIAVE_CATALOGO = (
+    'categoria', 'tipologia', 'taglia', 'fit', 'colore',
+    'brand', 'destinazione', 'immagine', 'immagine2',
+)
+
+
+def chiave_catalogo(capo: dict) -> str:
+    """Hash stabile della tupla CHIAVE_CATALOGO di un capo."""
+    raw = json.dumps([capo.get(c) for c in CHIAVE_CATALOGO], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
 
 def get_aggregated_capi():
     """
     Legge tutti i capi da tutti i wardrobe e li aggrega
     come nella pagina public_wardrobe (disponibilita).
     Ritorna una lista di dict.
+
+    Lavora sulle tabelle sorgente: serve solo per ricostruire il catalogo
+    materializzato (vedi ricostruisci_catalogo); la home legge get_catalogo().
     """
-    metadata = MetaData()
-    all_capi = []
+    if STORAGE_CONDIVISO:
+        with engine.connect() as conn:
+            return _conta_capi_uguali(conn, Capo.__table__)
+
+    aggregated = {}
 
-    wardrobes = db_session.query(Wardrobe).all()
+    # select sulle sole colonne che servono (non il modello intero): gira
+    # anche dalla migrazione 4, prima che esistano le colonne aggiunte dopo
+    wardrobes_table = Wardrobe.__table__
+    with engine.connect() as conn:
+        wardrobes = conn.execute(select(wardrobes_table.c.id, wardrobes_table.c.nome)).fetchall()
 
     for w in wardrobes:
         try:
-            tbl = Table(w.nome, metadata, autoload_with=engine)
+            tbl, _ = tabella_capi(w)
         except Exception:
             continue
 
         with engine.connect() as conn:
-            rows = conn.execute(tbl.select()).fetchall()
-            columns = tbl.columns.keys()
+            for r in _conta_capi_uguali(conn, tbl):
+                key = chiave_catalogo(r)
+                if key not in aggregated:
+                    aggregated[key] = r
+                else:
+                    item = aggregated[key]
+                    item['disponibilita'] += r['disponibilita']
+                    if (r.get('created_at') or '') > (item.get('created_at') or ''):
+                        item['created_at'] = r['created_at']
+
+    return list(aggregated.values())
 
-            for row in rows:
-                rd = dict(zip(columns, row))
-                all_capi.append(rd)
 
-    # --- AGGREGAZIONE CAPi UGUALI ---
-    aggregated = {}
-    for r in all_capi:
-        key = (
-            r.get('categoria'),
-            r.get('tipologia'),
-            r.get('taglia'),
-            r.get('fit'),
-            r.get('colore'),
-            r.get('brand'),
-            r.get('destinazione'),
-            r.get('immagine'),
-            r.get('immagine2'),
+def _conta_capi_uguali(conn, tbl, *where):
+    """
+    GROUP BY sulla tabella di un wardrobe: una riga per gruppo di capi uguali
+    con i pezzi totali in `disponibilita` e il created_at più recente.
+    """
+    cols = [tbl.c[c] for c in CHIAVE_CATALOGO if c in tbl.c]
+    extra = [func.sum(tbl.c.quantita).label('disponibilita')]
+    if 'created_at' in tbl.c:
+        extra.append(func.max(tbl.c.created_at).label('created_at'))
+
+    rows = conn.execute(select(*cols, *extra).where(*where).group_by(*cols)).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def aggiorna_catalogo(conn, capo: dict, delta: int) -> None:
+    """
+    Applica `delta` pezzi alla voce di catalogo del capo, dentro la
+    transazione `conn` della route che ha modificato il wardrobe.
+    Le voci che scendono a 0 restano come esaurite (disponibilita 0); le
+    voci scalate le ricontrolla controlla_prenotazioni prima del commit.
+    """
+    if not delta:
+        return
+
+    tbl = CatalogoCapo.__table__
+    chiave = chiave_catalogo(capo)
+    # la versione la assegna il commit (vedi _nuova_versione_catalogo)
+    conn.info.setdefault('voci_modificate', set()).add(chiave)
+
+    if delta < 0:
+        conn.info.setdefault('voci_scalate', set()).add(chiave)
+        conn.execute(
+            tbl.update()
+               .where(tbl.c.chiave == chiave)
+               .values(disponibilita=tbl.c.disponibilita + delta)
+        )
+        return
+
+    values = {'disponibilita': tbl.c.disponibilita + delta}
+    created_at = capo.get('created_at')
+    if created_at:
+        # teniamo il created_at più recente del gruppo (serve per i featured)
+        values['created_at'] = case(
+            (tbl.c.created_at.is_(None), created_at),
+            (tbl.c.created_at < created_at, created_at),
+            else_=tbl.c.created_at
         )
-        if key not in aggregated:
-            item = dict(r)
-            item['disponibilita'] = 1
-            aggregated[key] = item
+
+    res = conn.execute(tbl.update().where(tbl.c.chiave == chiave).values(**values))
+    if res.rowcount:
+        return
+
+    try:
+        with conn.begin_nested():
+            res = conn.execute(tbl.insert().values(
+                chiave=chiave,
+                disponibilita=delta,
+                created_at=created_at or '',
+                versione=0,
+                **{c: capo.get(c) for c in CHIAVE_CATALOGO}
+            ))
+            # il testo di una voce non cambia mai (fa parte della chiave):
+            # basta indicizzarla quando nasce
+            indicizza_voci(conn, [dict(capo, id=res.inserted_primary_key[0])])
+    except IntegrityError:
+        # inserita nel frattempo da un'altra richiesta: riprovo l'update
+        conn.execute(tbl.update().where(tbl.c.chiave == chiave).values(**values))
+
+
+def _nuova_versione_catalogo(conn, chiavi, ricostruzione: bool = False) -> int:
+    """
+    Incrementa il contatore del catalogo e vi allinea le voci `chiavi` (tutte
+    se `ricostruzione`). Gira dall'hook di commit, una volta per transazione:
+    la riga unica del contatore resta bloccata solo fino al commit subito
+    dopo, non per tutta la transazione (gli import a lotti, le altre route),
+    e le versioni vengono comunque assegnate nello stesso ordine dei commit.
+    """
+    ver = CatalogoVersione.__table__
+    tbl = CatalogoCapo.__table__
+    values = {'versione': ver.c.versione + 1}
+    if ricostruzione:
+        values['ricostruzione'] = ver.c.ricostruzione + 1
+    versione = conn.execute(
+        ver.update().where(ver.c.id == 1).values(**values).returning(ver.c.versione)
+    ).scalar()
+    if ricostruzione:
+        conn.execute(tbl.update().values(versione=versione))
+        return versione
+    chiavi = sorted(chiavi)
+    for i in range(0, len(chiavi), 500):
+        conn.execute(tbl.update().where(tbl.c.chiave.in_(chiavi[i:i + 500])).values(versione=versione))
+    return versione
+
+
+def versione_catalogo() -> tuple[int, int]:
+    """(versione, ricostruzione) correnti del catalogo pubblico."""
+    ver = CatalogoVersione.__table__
+    with engine.connect() as conn:
+        row = conn.execute(
+            select(ver.c.versione, ver.c.ricostruzione).where(ver.c.id == 1)
+        ).first()
+    return (row.versione, row.ricostruzione) if row else (0, 0)
+
+
+def rimuovi_dal_catalogo(conn, tbl, *where) -> None:
+    """Scala dal catalogo tutti i capi di `tbl` che soddisfano `where` (prima di cancellarli)."""
+    for r in _conta_capi_uguali(conn, tbl, *where):
+        aggiorna_catalogo(conn, r, -r['disponibilita'])
+
+
+def ricostruisci_catalogo() -> int:
+    """
+    Ricostruisce da zero il catalogo materializzato leggendo tutti i wardrobe.
+    Da usare per recovery (flask ricostruisci-catalogo). Ritorna il numero di voci.
+    """
+    capi = get_aggregated_capi()
+    tbl = CatalogoCapo.__table__
+
+    with engine.begin() as conn:
+        conn.info['catalogo_ricostruito'] = True
+        conn.execute(tbl.delete())
+        if capi:
+            conn.execute(tbl.insert(), [
+                dict(
+                    chiave=chiave_catalogo(c),
+                    disponibilita=c['disponibilita'],
+                    created_at=c.get('created_at') or '',
+                    versione=0,
+                    **{k: c.get(k) for k in CHIAVE_CATALOGO}
+                )
+                for c in capi
+            ])
+        reindicizza_ricerca(conn)
+    return len(capi)
+
+
+def get_catalogo():
+    """
+    Catalogo pubblico già aggregato (una sola query indicizzata),
+    dai capi più recenti ai più vecchi.
+    """
+    tbl = CatalogoCapo.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(
+            tbl.select()
+               .where(tbl.c.disponibilita > 0)
+               .order_by(tbl.c.created_at.desc(), tbl.c.id.desc())
+        ).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+# filtri accettati dal catalogo pubblico (/api/catalog e sidebar della home)
+FILTRI_CATALOGO = ('categoria', 'taglia', 'brand', 'destinazione', 'colore')
+PAGINA_CATALOGO = 24
+MAX_PAGINA_CATALOGO = 100
+
+
+def _codifica_cursore(capo: dict) -> str:
+    raw = json.dumps([capo['created_at'], capo['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decodifica_cursore(cursore: str):
+    """(created_at, id) dal cursore opaco; ValueError se non valido."""
+    try:
+        raw = base64.urlsafe_b64decode(cursore + '=' * (-len(cursore) % 4))
+        created_at, capo_id = json.loads(raw)
+    except Exception:
+        raise ValueError("cursore non valido")
+    if not isinstance(created_at, str) or not isinstance(capo_id, int):
+        raise ValueError("cursore non valido")
+    return created_at, capo_id
+
+
+def cerca_catalogo(filtri: dict, limite: int = PAGINA_CATALOGO,
+                   cursore: str | None = None, crescente: bool = False):
+    """
+    Una pagina del catalogo pubblico filtrata per uguaglianza sui
+    FILTRI_CATALOGO e ordinata per created_at (poi id). Paginazione keyset:
+    il cursore è la chiave (created_at, id) dell'ultima voce restituita.
+    Ritorna (voci, cursore_successivo oppure None).
+    """
+    tbl = CatalogoCapo.__table__
+    where = [tbl.c[k] == v for k, v in filtri.items() if k in FILTRI_CATALOGO and v]
+    where.append(tbl.c.disponibilita > 0)
+
+    if cursore:
+        created_at, capo_id = _decodifica_cursore(cursore)
+        if crescente:
+            where.append((tbl.c.created_at > created_at)
+                         | ((tbl.c.created_at == created_at) & (tbl.c.id > capo_id)))
         else:
-            aggregated[key]['disponibilita'] += 1
+            where.append((tbl.c.created_at < created_at)
+                         | ((tbl.c.created_at == created_at) & (tbl.c.id < capo_id)))
 
-    return list(aggregated.values())
+    if crescente:
+        ordine = (tbl.c.created_at.asc(), tbl.c.id.asc())
+    else:
+        ordine = (tbl.c.created_at.desc(), tbl.c.id.desc())
+
+    with engine.connect() as conn:
+        rows = conn.execute(
+            tbl.select().where(*where).order_by(*ordine).limit(limite + 1)
+        ).fetchall()
+
+    capi = [dict(row._mapping) for row in rows[:limite]]
+    prossimo = _codifica_cursore(capi[-1]) if len(rows) > limite else None
+    return capi, prossimo
+
+
+def conta_catalogo(filtri: dict) -> int:
+    """Numero di voci del catalogo che soddisfano i filtri."""
+    tbl = CatalogoCapo.__table__
+    where = [tbl.c[k] == v for k, v in filtri.items() if k in FILTRI_CATALOGO and v]
+    where.append(tbl.c.disponibilita > 0)
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(tbl).where(*where)).scalar()
+
+
+# facette dell'indice in memoria (i filtri della sidebar + tipologia e fit)
+FACETTE_CATALOGO = FILTRI_CATALOGO + ('tipologia', 'fit')
+# ogni quanto (secondi) l'indice controlla se il catalogo è cambiato
+INTERVALLO_SYNC_FACETTE = float(os.environ.get("INTERVALLO_SYNC_FACETTE", "1.0"))
+
+
+class IndiceFacette:
+    """
+    Indice in memoria del catalogo pubblico per la ricerca a faccette.
+
+    Ogni voce del catalogo occupa un bit (slot); per ogni facetta i valori
+    sono codificati a dizionario (valore -> codice) e ogni codice ha la sua
+    bitmap (un int Python) con gli slot delle voci che hanno quel valore.
+    Una query congiuntiva è un AND di bitmap, un conteggio è un bit_count().
+
+    Si aggiorna in modo incrementale leggendo solo le voci con
+    `versione` maggiore dell'ultima vista; dopo un ricostruisci_catalogo
+    si ricarica da zero.
+    """
+
+    def __init__(self, facette=FACETTE_CATALOGO):
+        self.facette = tuple(facette)
+        self._lock = threading.RLock()
+        self._svuota()
+
+    def _svuota(self):
+        self.versione = -1
+        self.ricostruzione = -1
+        self._ultimo_sync = 0.0
+        self._slot = {}         # id voce -> slot
+        self._voci = {}         # slot -> voce (dict)
+        self._slot_liberi = []
+        self._prossimo_slot = 0
+        self._tutti = 0         # bitmap degli slot occupati
+        self._codici = {f: {} for f in self.facette}    # facetta -> valore -> codice
+        self._valori = {f: [] for f in self.facette}    # facetta -> codice -> valore
+        self._bitmap = {f: [] for f in self.facette}    # facetta -> codice -> bitmap
+
+    # --- manutenzione -------------------------------------------------
+
+    def _codice(self, facetta, valore):
+        codici = self._codici[facetta]
+        codice = codici.get(valore)
+        if codice is None:
+            codice = codici[valore] = len(self._valori[facetta])
+            self._valori[facetta].append(valore)
+            self._bitmap[facetta].append(0)
+        return codice
+
+    def _togli(self, voce_id):
+        slot = self._slot.pop(voce_id, None)
+        if slot is None:
+            return
+        voce = self._voci.pop(slot)
+        bit = 1 << slot
+        for f in self.facette:
+            codice = self._codici[f][voce.get(f)]
+            self._bitmap[f][codice] &= ~bit
+        self._tutti &= ~bit
+        self._slot_liberi.append(slot)
+
+    def _metti(self, voce):
+        self._togli(voce['id'])
+        if voce['disponibilita'] <= 0:
+            return
+        if self._slot_liberi:
+            slot = self._slot_liberi.pop()
+        else:
+            slot = self._prossimo_slot
+            self._prossimo_slot += 1
+        bit = 1 << slot
+        self._slot[voce['id']] = slot
+        self._voci[slot] = voce
+        for f in self.facette:
+            self._bitmap[f][self._codice(f, voce.get(f))] |= bit
+        self._tutti |= bit
+
+    def sincronizza(self, forza: bool = False) -> None:
+        """Allinea l'indice al catalogo (al massimo ogni INTERVALLO_SYNC_FACETTE secondi)."""
+        adesso = time.monotonic()
+        if not forza and adesso - self._ultimo_sync < INTERVALLO_SYNC_FACETTE:
+            return
+
+        with self._lock:
+            versione, ricostruzione = versione_catalogo()
+            self._ultimo_sync = adesso
+            if versione == self.versione and ricostruzione == self.ricostruzione:
+                return
+
+            tbl = CatalogoCapo.__table__
+            query = tbl.select()
+            if ricostruzione != self.ricostruzione:
+                self._svuota()
+                self._ultimo_sync = adesso
+            else:
+                query = query.where(tbl.c.versione > self.versione)
+
+            with engine.connect() as conn:
+                for row in conn.execute(query):
+                    self._metti(dict(row._mapping))
+
+            self.versione, self.ricostruzione = versione, ricostruzione
+
+    # --- interrogazione -----------------------------------------------
+
+    def _maschera(self, filtri: dict, escludi=None) -> int:
+        """
+        Bitmap delle voci che soddisfano i filtri (AND tra facette, OR tra
+        più valori della stessa facetta), ignorando la facetta `escludi`.
+        """
+        maschera = self._tutti
+        for f, valori in filtri.items():
+            if f == escludi or f not in self._codici or valori in (None, '', []):
+                continue
+            if isinstance(valori, str):
+                valori = [valori]
+            unione = 0
+            for v in valori:
+                codice = self._codici[f].get(v)
+                if codice is not None:
+                    unione |= self._bitmap[f][codice]
+            maschera &= unione
+        return maschera
+
+    def cerca(self, filtri: dict) -> list[dict]:
+        """Voci che soddisfano i filtri, dalle più recenti."""
+        self.sincronizza()
+        with self._lock:
+            maschera = self._maschera(filtri)
+            voci = []
+            while maschera:
+                basso = maschera & -maschera
+                voci.append(self._voci[basso.bit_length() - 1])
+                maschera ^= basso
+        voci.sort(key=lambda v: (v['created_at'] or '', v['id']), reverse=True)
+        return voci
+
+    def conta(self, filtri: dict) -> int:
+        self.sincronizza()
+        with self._lock:
+            return self._maschera(filtri).bit_count()
+
+    def conteggi(self, filtri: dict, facette=None) -> dict:
+        """
+        Per ogni facetta, quante voci avrebbe ciascun valore tenendo fermi i
+        filtri sulle ALTRE facette (i conteggi da mostrare accanto alle
+        opzioni). Valori a 0 omessi, salvo quello selezionato.
+        """
+        self.sincronizza()
+        risultato = {}
+        with self._lock:
+            for f in facette or self.facette:
+                base = self._maschera(filtri, escludi=f)
+                scelti = filtri.get(f) or []
+                if isinstance(scelti, str):
+                    scelti = [scelti]
+                conteggi = {}
+                for codice, bitmap in enumerate(self._bitmap[f]):
+                    valore = self._valori[f][codice]
+                    n = (bitmap & base).bit_count()
+                    if valore not in (None, '') and (n or valore in scelti):
+                        conteggi[valore] = n
+                risultato[f] = dict(sorted(conteggi.items()))
+        return risultato
+
+
+indice_facette = IndiceFacette()
+
+
+@event.listens_for(engine, 'commit')
+def _catalogo_modificato(conn):
+    conn.info.pop('voci_scalate', None)
+    voci = conn.info.pop('voci_modificate', None)
+    ricostruito = conn.info.pop('catalogo_ricostruito', False)
+    if voci or ricostruito:
+        # eseguito prima del COMMIT vero e proprio, nella stessa transazione
+        _nuova_versione_catalogo(conn, voci or (), ricostruito)
+        # chi ha scritto sul catalogo rilegge subito la versione alla prossima
+        # richiesta (indice e frammenti della home), senza aspettare l'intervallo
+        indice_facette._ultimo_sync = 0.0
+
+
+@event.listens_for(engine, 'rollback')
+def _catalogo_annullato(conn):
+    for chiave in ('voci_scalate', 'voci_modificate', 'catalogo_ricostruito'):
+        conn.info.pop(chiave, None)
+
+
+# ----------------------------
+#       METRICHE (Prometheus)
+# ----------------------------
+
+# Esposte su /metrics. Con gunicorn (più processi) va impostata
+# PROMETHEUS_MULTIPROC_DIR (cartella vuota, scrivibile) PRIMA di avviare
+# l'app: ogni worker scrive i suoi valori lì e /metrics li somma.
+# Nel config di gunicorn, all'uscita di un worker:
+#     def child_exit(server, worker):
+#         from prometheus_client import multiprocess
+#         multiprocess.mark_process_dead(worker.pid)
+METRICHE_MULTIPROCESSO = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKET_QUERY = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class _MetricaNulla:
+    """Segnaposto quando prometheus_client non è installato: non fa nulla."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, *args):
+        pass
+
+    def dec(self, *args):
+        pass
+
+    def observe(self, *args):
+        pass
+
+
+def _metrica(tipo: str, nome: str, descrizione: str, etichette=(), **kwargs):
+    if prometheus_client is None:
+        return _MetricaNulla()
+    return getattr(prometheus_client, tipo)(nome, descrizione, list(etichette), **kwargs)
+
+
+RICHIESTE_SECONDI = _metrica(
+    'Histogram', 'stycly_richiesta_secondi', 'Durata delle richieste per endpoint',
+    ('endpoint', 'metodo'), buckets=BUCKET_SECONDI
+)
+RICHIESTE_TOTALE = _metrica(
+    'Counter', 'stycly_richieste_total', 'Richieste servite per endpoint e stato HTTP',
+    ('endpoint', 'metodo', 'stato')
+)
+RICHIESTE_IN_CORSO = _metrica(
+    'Gauge', 'stycly_richieste_in_corso', 'Richieste in elaborazione per endpoint',
+    ('endpoint',), multiprocess_mode='livesum'
+)
+SQL_QUERY_RICHIESTA = _metrica(
+    'Histogram', 'stycly_sql_query_per_richiesta', 'Query SQL eseguite da una richiesta',
+    ('endpoint',), buckets=BUCKET_QUERY
+)
+SQL_SECONDI_RICHIESTA = _metrica(
+    'Histogram', 'stycly_sql_secondi_per_richiesta', 'Tempo passato nel DB da una richiesta',
+    ('endpoint',), buckets=BUCKET_SECONDI
+)
+SQL_QUERY_TOTALE = _metrica(
+    'Counter', 'stycly_sql_query_total', 'Query SQL eseguite (anche fuori dalle richieste)'
+)
+TEMPLATE_SECONDI = _metrica(
+    'Histogram', 'stycly_template_secondi', 'Tempo di render per template Jinja',
+    ('template',), buckets=BUCKET_SECONDI
+)
+IMMAGINI_BYTE = _metrica(
+    'Counter', 'stycly_immagini_byte_total', 'Byte di immagini serviti da /immagini',
+    ('tipo',)
+)
+CACHE_ACCESSI = _metrica(
+    'Counter', 'stycly_cache_total', 'Letture delle cache in memoria',
+    ('cache', 'esito')
+)
+LOGIN_RIFIUTATI = _metrica(
+    'Counter', 'stycly_login_rifiutati_total',
+    'Tentativi di login respinti dal limite prima della verifica password', ('limite',)
+)
+
+
+# Profiler SQL. SQL_PROFILER=1 (attivo anche in debug/test) registra la
+# "forma" di ogni query della richiesta e segnala le forme ripetute almeno
+# SQL_N_PIU_1 volte (il classico N+1: una query per wardrobe/tabella), e
+# aggiunge l'header Server-Timing (db, template, totale). Le query più
+# lente di SQL_LENTA_MS vengono sempre loggate con la route.
+SQL_PROFILER = os.environ.get("SQL_PROFILER", "0") == "1"
+SQL_N_PIU_1 = int(os.environ.get("SQL_N_PIU_1", "5"))
+SQL_LENTA_MS = float(os.environ.get("SQL_LENTA_MS", "500"))
+
+_RE_FORMA_SQL = (
+    (re.compile(r"\bwardrobe_\w+"), "wardrobe_*"),            # tabelle per utente
+    (re.compile(r"'(?:[^']|'')*'"), "?"),                    # stringhe letterali
+    (re.compile(r"\b\d+\b"), "?"),                           # numeri
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),     # IN (?, ?, ...)
+    (re.compile(r"\s+"), " "),
+)
+
+
+def forma_query(statement: str) -> str:
+    """Query normalizzata: uguale per tutte le ripetizioni di un N+1."""
+    for regex, sostituto in _RE_FORMA_SQL:
+        statement = regex.sub(sostituto, statement)
+    return statement.strip()
+
+
+def profiler_attivo() -> bool:
+    return SQL_PROFILER or app.debug or app.testing
+
+
+def _endpoint_metrica() -> str:
+    # endpoint Flask e non path: le etichette restano poche (niente id negli URL)
+    return request.endpoint or 'nessuno'
+
+
+@app.before_request
+def _inizio_richiesta_metriche():
+    g.inizio_richiesta = time.perf_counter()
+    g.sql_query = 0
+    g.sql_secondi = 0.0
+    g.template_secondi = 0.0
+    g.sql_forme = {} if profiler_attivo() else None
+    g.endpoint_metrica = _endpoint_metrica()
+    RICHIESTE_IN_CORSO.labels(endpoint=g.endpoint_metrica).inc()
+
+
+@app.after_request
+def _stato_richiesta_metriche(response):
+    g.stato_risposta = response.status_code
+    if g.get('sql_forme') is not None and 'inizio_richiesta' in g:
+        totale = time.perf_counter() - g.inizio_richiesta
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.sql_secondi * 1000:.1f};desc="{g.sql_query} query", '
+            f'tpl;dur={g.template_secondi * 1000:.1f}, '
+            f'app;dur={totale * 1000:.1f}'
+        )
+        segnala_n_piu_1(g.sql_forme)
+    return response
+
+
+def segnala_n_piu_1(forme: dict) -> None:
+    """Logga le query eseguite SQL_N_PIU_1 o più volte nella stessa richiesta."""
+    for forma, (volte, secondi) in forme.items():
+        if volte >= SQL_N_PIU_1:
+            print(f"Possibile N+1 in {request.method} {request.path} ({g.endpoint_metrica}): "
+                  f"{volte} volte, {secondi * 1000:.1f} ms: {forma[:200]}")
+
+
+@app.teardown_request
+def _fine_richiesta_metriche(exc=None):
+    inizio = g.pop('inizio_richiesta', None)
+    if inizio is None:
+        return
+    endpoint = g.endpoint_metrica
+    stato = g.get('stato_risposta', 500)
+    RICHIESTE_IN_CORSO.labels(endpoint=endpoint).dec()
+    RICHIESTE_SECONDI.labels(endpoint=endpoint, metodo=request.method).observe(time.perf_counter() - inizio)
+    RICHIESTE_TOTALE.labels(endpoint=endpoint, metodo=request.method, stato=str(stato)).inc()
+    SQL_QUERY_RICHIESTA.labels(endpoint=endpoint).observe(g.sql_query)
+    SQL_SECONDI_RICHIESTA.labels(endpoint=endpoint).observe(g.sql_secondi)
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _inizio_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inizio_query', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _fine_query(conn, cursor, statement, parameters, context, executemany):
+    durata = time.perf_counter() - conn.info['inizio_query'].pop()
+    SQL_QUERY_TOTALE.inc()
+    # i thread della coda lavori non hanno una richiesta
+    in_richiesta = has_app_context() and 'inizio_richiesta' in g
+    if in_richiesta:
+        g.sql_query += 1
+        g.sql_secondi += durata
+        if g.sql_forme is not None:
+            forma = forma_query(statement)
+            volte, secondi = g.sql_forme.get(forma, (0, 0.0))
+            g.sql_forme[forma] = (volte + 1, secondi + durata)
+
+    if durata * 1000 >= SQL_LENTA_MS:
+        dove = f"{request.method} {request.path}" if in_richiesta else "fuori richiesta"
+        print(f"Query lenta ({durata * 1000:.0f} ms) in {dove}: {' '.join(statement.split())[:500]}")
 
 
+@event.listens_for(engine, 'handle_error')
+def _errore_query(contesto):
+    # la query fallita non arriva ad after_cursor_execute
+    if contesto.connection is not None:
+        inizi = contesto.connection.info.get('inizio_query')
+        if inizi:
+            inizi.pop()
 
-def ensure_schema():
+
+def _inizio_template(sender, template, context, **extra):
+    g.setdefault('inizio_template', []).append(time.perf_counter())
+
+
+def _fine_template(sender, template, context, **extra):
+    inizi = g.get('inizio_template')
+    if inizi:
+        durata = time.perf_counter() - inizi.pop()
+        TEMPLATE_SECONDI.labels(template=template.name or 'stringa').observe(durata)
+        # solo i template esterni: quelli annidati sono già nel loro tempo
+        if not inizi and 'template_secondi' in g:
+            g.template_secondi += durata
+
+
+before_render_template.connect(_inizio_template, app)
+template_rendered.connect(_fine_template, app)
+
+
+# ----------------------------
+#     RICERCA FULL-TEXT
+# ----------------------------
+# Indice full-text sulle voci del catalogo pubblico:
+# - SQLite:   tabella virtuale FTS5 `catalogo_fts` (rowid = id della voce)
+# - Postgres: tabella `catalogo_ricerca` con tsvector e indice GIN
+# Il testo viene normalizzato in Python (minuscole, senza accenti, radice
+# italiana leggera) sia in indicizzazione che in ricerca, così i due motori
+# si comportano allo stesso modo ("camicia" trova anche "camicie").
+
+# campi indicizzati: il "titolo" pesa di più nel ranking
+CAMPI_TITOLO_RICERCA = ('tipologia', 'categoria', 'brand')
+CAMPI_DETTAGLI_RICERCA = ('colore', 'fit', 'destinazione', 'taglia')
+MAX_RISULTATI_RICERCA = 100
+
+# motore in uso ('sqlite', 'postgresql' oppure None = fallback con LIKE),
+# deciso da rileva_motore_ricerca() all'avvio
+MOTORE_RICERCA = None
+
+
+def radice_italiana(parola: str) -> str:
+    """
+    Stemmer leggero per l'italiano: toglie la desinenza di genere/numero
+    (camicia/camicie -> camic, giacca/giacche -> giacc, nero/neri -> ner).
+    """
+    if len(parola) <= 3 or not parola.isalpha():
+        return parola
+    if parola[-3:] in ('che', 'chi', 'ghe', 'ghi'):
+        return parola[:-2]
+    if len(parola) > 4 and parola[-2] == 'i' and parola[-1] in 'aeio':
+        return parola[:-2]
+    if parola[-1] in 'aeiou':
+        return parola[:-1]
+    return parola
+
+
+def normalizza_testo(testo) -> list[str]:
+    """Token normalizzati (minuscole, senza accenti, radice) di un testo."""
+    testo = unicodedata.normalize('NFKD', str(testo or '').lower())
+    testo = ''.join(c for c in testo if not unicodedata.combining(c))
+    return [radice_italiana(t) for t in re.findall(r'[a-z0-9]+', testo)]
+
+
+def _testo_voce(voce: dict, campi) -> str:
+    return ' '.join(t for c in campi for t in normalizza_testo(voce.get(c)))
+
+
+def rileva_motore_ricerca() -> None:
+    """
+    Sceglie il motore full-text senza interrogare il DB: Postgres ha sempre
+    il suo, SQLite solo se compilato con FTS5 (provato su un DB in memoria).
+    """
+    global MOTORE_RICERCA
+    dialetto = engine.dialect.name
+    if dialetto == 'sqlite':
+        import sqlite3
+        try:
+            prova = sqlite3.connect(':memory:')
+            try:
+                prova.execute("CREATE VIRTUAL TABLE prova USING fts5(testo)")
+            finally:
+                prova.close()
+        except sqlite3.Error as e:
+            # es. SQLite compilato senza FTS5: si ripiega sul LIKE
+            print("Errore indice ricerca (FTS5 non disponibile):", e)
+            return
+    elif dialetto != 'postgresql':
+        return
+    MOTORE_RICERCA = dialetto
+
+
+def crea_indice_ricerca(conn) -> None:
+    """Crea (se manca) l'indice full-text del motore in uso (nella transazione `conn`)."""
+    if MOTORE_RICERCA == 'sqlite':
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS catalogo_fts
+            USING fts5(titolo, dettagli, tokenize='unicode61', prefix='2 3')
+        """))
+    elif MOTORE_RICERCA == 'postgresql':
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS catalogo_ricerca (
+                id INTEGER PRIMARY KEY,
+                documento TSVECTOR NOT NULL
+            )
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_catalogo_ricerca_documento
+            ON catalogo_ricerca USING GIN (documento)
+        """))
+
+
+rileva_motore_ricerca()
+
+
+def indicizza_voci(conn, voci) -> None:
+    """Aggiunge (o sostituisce) nell'indice full-text le voci del catalogo, nella transazione `conn`."""
+    if not MOTORE_RICERCA or not voci:
+        return
+
+    righe = [
+        {
+            'id': v['id'],
+            'titolo': _testo_voce(v, CAMPI_TITOLO_RICERCA),
+            'dettagli': _testo_voce(v, CAMPI_DETTAGLI_RICERCA),
+        }
+        for v in voci
+    ]
+
+    if MOTORE_RICERCA == 'sqlite':
+        conn.execute(text("DELETE FROM catalogo_fts WHERE rowid = :id"), righe)
+        conn.execute(text("""
+            INSERT INTO catalogo_fts (rowid, titolo, dettagli)
+            VALUES (:id, :titolo, :dettagli)
+        """), righe)
+    else:
+        conn.execute(text("""
+            INSERT INTO catalogo_ricerca (id, documento)
+            VALUES (:id, setweight(to_tsvector('simple', :titolo), 'A')
+                         || setweight(to_tsvector('simple', :dettagli), 'B'))
+            ON CONFLICT (id) DO UPDATE SET documento = EXCLUDED.documento
+        """), righe)
+
+
+def reindicizza_ricerca(conn) -> None:
+    """Svuota e ricostruisce l'indice full-text dal catalogo (nella transazione `conn`)."""
+    if not MOTORE_RICERCA:
+        return
+    if MOTORE_RICERCA == 'sqlite':
+        conn.execute(text("DELETE FROM catalogo_fts"))
+    else:
+        conn.execute(text("DELETE FROM catalogo_ricerca"))
+
+    tbl = CatalogoCapo.__table__
+    voci = [dict(r._mapping) for r in conn.execute(tbl.select())]
+    indicizza_voci(conn, voci)
+
+
+def indice_ricerca_vuoto(conn) -> bool:
+    if not MOTORE_RICERCA:
+        return False
+    nome = 'catalogo_fts' if MOTORE_RICERCA == 'sqlite' else 'catalogo_ricerca'
+    return conn.execute(text(f"SELECT 1 FROM {nome} LIMIT 1")).first() is None
+
+
+def cerca_testo(q: str, filtri: dict | None = None,
+                limite: int = PAGINA_CATALOGO, offset: int = 0):
+    """
+    Ricerca full-text nel catalogo pubblico (voci disponibili), con match
+    per prefisso su ogni parola e ordinamento per rilevanza (bm25 su SQLite,
+    ts_rank su Postgres). `filtri` come in cerca_catalogo.
+    Ritorna (voci, ci_sono_altri_risultati).
+    """
+    token = normalizza_testo(q)
+    if not token:
+        return [], False
+
+    tbl = CatalogoCapo.__table__
+    filtri = {k: v for k, v in (filtri or {}).items() if k in FILTRI_CATALOGO and v}
+    params = {f'f_{k}': v for k, v in filtri.items()}
+    params.update(limite=limite + 1, offset=offset)
+    condizioni = ''.join(f' AND c.{k} = :f_{k}' for k in filtri)
+
+    with engine.connect() as conn:
+        if MOTORE_RICERCA == 'sqlite':
+            params['q'] = ' '.join(f'"{t}"*' for t in token)
+            rows = conn.execute(text(f"""
+                SELECT c.*
+                FROM catalogo_fts
+                JOIN catalogo_pubblico c ON c.id = catalogo_fts.rowid
+                WHERE catalogo_fts MATCH :q AND c.disponibilita > 0{condizioni}
+                ORDER BY bm25(catalogo_fts, 4.0, 1.0), c.created_at DESC, c.id DESC
+                LIMIT :limite OFFSET :offset
+            """), params).fetchall()
+        elif MOTORE_RICERCA == 'postgresql':
+            params['q'] = ' & '.join(f'{t}:*' for t in token)
+            rows = conn.execute(text(f"""
+                SELECT c.*
+                FROM catalogo_ricerca r
+                JOIN catalogo_pubblico c ON c.id = r.id,
+                     to_tsquery('simple', :q) query
+                WHERE r.documento @@ query AND c.disponibilita > 0{condizioni}
+                ORDER BY ts_rank(r.documento, query) DESC, c.created_at DESC, c.id DESC
+                LIMIT :limite OFFSET :offset
+            """), params).fetchall()
+        else:
+            # senza indice: LIKE su tutti i campi (scansione completa)
+            campi = CAMPI_TITOLO_RICERCA + CAMPI_DETTAGLI_RICERCA
+            where = [tbl.c[k] == v for k, v in filtri.items()]
+            where.append(tbl.c.disponibilita > 0)
+            for t in token:
+                where.append(or_(*(func.lower(tbl.c[c]).like(f'%{t}%') for c in campi)))
+            rows = conn.execute(
+                tbl.select().where(*where)
+                   .order_by(tbl.c.created_at.desc(), tbl.c.id.desc())
+                   .limit(limite + 1).offset(offset)
+            ).fetchall()
+
+    capi = [dict(row._mapping) for row in rows[:limite]]
+    return capi, len(rows) > limite
+
+
+
+# sessione DB: una per thread/richiesta, chiusa a fine richiesta
+# (vedi chiudi_sessione_db)
+Session = sessionmaker(bind=engine)
+db_session = scoped_session(Session)
+
+
+@app.teardown_appcontext
+def chiudi_sessione_db(exc=None):
+    """Restituisce al pool la connessione della sessione della richiesta."""
+    db_session.remove()
+
+
+# ----------------------------
+#       FUNZIONI UTILI
+# ----------------------------
+
+def allowed_file(filename: str) -> bool:
+    return (
+        '.' in filename
+        and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    )
+
+
+def genera_derivati(cartella: str, filename: str, forza: bool = False) -> list[str]:
+    """
+    Crea i derivati di un'immagine caricata: ruotata secondo l'EXIF, senza
+    metadati, ridimensionata a ogni LARGHEZZE_DERIVATI (mai ingrandita), in
+    JPEG e WebP. Funzione "pura" (niente app/DB) per poterla usare anche nei
+    processi del backfill. Ritorna i nomi dei file creati.
     """
-    Si assicura che le tabelle users e wardrobes siano allineate
-    (solo su Postgres controlliamo/ droppiamo se schema vecchio).
+    if Image is None:
+        return []
+
+    dest = os.path.join(cartella, CARTELLA_DERIVATI)
+    os.makedirs(dest, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    creati = []
+
+    with Image.open(os.path.join(cartella, filename)) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+            sfondo = Image.new('RGB', im.size, (255, 255, 255))
+            sfondo.paste(im, mask=im.getchannel('A'))
+            im = sfondo
+        elif im.mode != 'RGB':
+            im = im.convert('RGB')
+
+        for w in LARGHEZZE_DERIVATI:
+            nomi = {fmt: f"{stem}__w{w}.{fmt}" for fmt in ('jpg', 'webp')}
+            if forza or not all(os.path.exists(os.path.join(dest, n)) for n in nomi.values()):
+                # il primo taglio più largo dell'originale resta alla larghezza originale
+                target = min(w, im.width)
+                ridotta = im if target == im.width else im.resize(
+                    (target, round(im.height * target / im.width)), Image.LANCZOS
+                )
+                # niente exif/icc: i derivati escono senza metadati
+                ridotta.save(os.path.join(dest, nomi['jpg']), 'JPEG',
+                             quality=82, optimize=True, progressive=True)
+                ridotta.save(os.path.join(dest, nomi['webp']), 'WEBP', quality=80, method=4)
+                creati.extend(nomi.values())
+            if w >= im.width:
+                break
+
+    return creati
+
+
+def salva_upload(file) -> str:
     """
+    Salva un upload calcolandone lo sha256 mentre lo scrive su disco e lo
+    registra in immagini_file. Se la stessa immagine esiste già non la
+    duplica. Ritorna il nome con cui referenziarla (<sha256>.<ext>).
+    """
+    cartella = app.config['UPLOAD_FOLDER']
+    os.makedirs(cartella, exist_ok=True)
+
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    if ext == 'jpeg':
+        ext = 'jpg'
+
+    tmp_path = os.path.join(cartella, f".upload-{uuid.uuid4().hex}")
+    h = hashlib.sha256()
+    dimensione = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                h.update(chunk)
+                out.write(chunk)
+                dimensione += len(chunk)
+
+        digest = h.hexdigest()
+        reg = ImmagineFile.__table__
+        # riusata: il periodo di grazia del GC riparte da adesso, PRIMA di
+        # guardare se il file c'è. Il GC cancella solo righe non toccate di
+        # recente e tiene bloccata la riga mentre toglie i file: o vede
+        # questo usato_at e salta l'immagine, o ha già finito e qui sotto
+        # il file risulta mancante e viene riscritto.
+        with engine.begin() as conn:
+            esistente = conn.execute(
+                reg.update().where(reg.c.sha256 == digest)
+                   .values(usato_at=datetime.now(timezone.utc).isoformat())
+                   .returning(reg.c.nome)
+            ).scalar()
+
+        nome = esistente or f"{digest}.{ext}"
+        nuovo = not os.path.exists(os.path.join(cartella, nome))
+        if nuovo:
+            os.replace(tmp_path, os.path.join(cartella, nome))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if not esistente:
+        try:
+            with engine.begin() as conn:
+                conn.execute(reg.insert().values(
+                    sha256=digest,
+                    nome=nome,
+                    dimensione=dimensione,
+                    nome_originale=secure_filename(file.filename),
+                    created_at=datetime.now(timezone.utc).isoformat()
+                ))
+        except IntegrityError:
+            pass  # stesso file caricato in contemporanea da un'altra richiesta
+
+    if nuovo:
+        # i derivati li genera la coda lavori: la richiesta non aspetta Pillow
+        accoda_lavoro('derivati', nome=nome)
+    return nome
+
+
+def scegli_derivato(filename: str, larghezza: int, formato: str) -> str | None:
+    """
+    Nome del derivato più piccolo largo almeno `larghezza` (o del più grande
+    disponibile), relativo a CARTELLA_DERIVATI; None se non ce ne sono.
+    """
+    cartella = os.path.join(app.config['UPLOAD_FOLDER'], CARTELLA_DERIVATI)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    candidati = sorted(LARGHEZZE_DERIVATI, key=lambda w: (w < larghezza, abs(w - larghezza)))
+    for w in candidati:
+        nome = f"{stem}__w{w}.{formato}"
+        if os.path.exists(os.path.join(cartella, nome)):
+            return nome
+    return None
+
+
+@app.template_global()
+def url_immagine(filename, w=None):
+    """URL di un'immagine caricata, eventualmente nella variante larga `w`."""
+    nome = (filename or '').split('/')[-1]
+    if w:
+        return url_for('immagini', filename=nome, w=w)
+    return url_for('immagini', filename=nome)
+
+
+@app.template_global()
+def srcset_immagine(filename):
+    """Attributo srcset con tutte le LARGHEZZE_DERIVATI di un'immagine."""
+    return ", ".join(f"{url_immagine(filename, w)} {w}w" for w in LARGHEZZE_DERIVATI)
+
+
+class CacheLRU:
+    """
+    Cache in memoria del processo: al più `dimensione` voci (le meno usate
+    escono per prime), ognuna valida per `ttl` secondi. Con più worker
+    ognuno ha la sua copia: il TTL limita quanto una voce può restare
+    vecchia in un worker che non ha visto l'invalidazione.
+    """
+
+    def __init__(self, nome: str, dimensione: int, ttl: float):
+        self.nome = nome
+        self.dimensione = dimensione
+        self.ttl = ttl
+        self._voci = OrderedDict()    # chiave -> (scadenza, valore)
+        self._lock = threading.Lock()
+        self._hit = CACHE_ACCESSI.labels(cache=nome, esito='hit')
+        self._miss = CACHE_ACCESSI.labels(cache=nome, esito='miss')
+
+    def get(self, chiave, default=None):
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is not None and voce[0] < time.monotonic():
+                del self._voci[chiave]
+                voce = None
+            if voce is None:
+                self._miss.inc()
+                return default
+            self._voci.move_to_end(chiave)
+            self._hit.inc()
+            return voce[1]
+
+    def set(self, chiave, valore) -> None:
+        with self._lock:
+            self._voci[chiave] = (time.monotonic() + self.ttl, valore)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.dimensione:
+                self._voci.popitem(last=False)
+
+    def invalida(self, chiave) -> None:
+        with self._lock:
+            self._voci.pop(chiave, None)
+
+
+def validate_password_strength(password: str) -> str | None:
+    """
+    Controlla robustezza password.
+    Ritorna messaggio di errore, oppure None se ok.
+    """
+    if len(password) < 8:
+        return "La password deve avere almeno 8 caratteri."
+    if not re.search(r"[A-Za-z]", password):
+        return "La password deve contenere almeno una lettera."
+    if not re.search(r"\d", password):
+        return "La password deve contenere almeno un numero."
+    return None
+
+
+def crea_tabella_wardrobe(nome_tabella: str) -> str:
+    """
+    Crea dinamicamente la tabella del wardrobe (per utente).
+    Colonne allineate a tutto il codice.
+    """
+    nome_tabella = re.sub(r'\W+', '_', nome_tabella.lower())
+    metadata = MetaData()
+    Table(
+        nome_tabella, metadata,
+        Column('id', Integer, primary_key=True),
+        Column('categoria', String),
+        Column('tipologia', String),
+        Column('taglia', String),
+        Column('fit', String),
+        Column('colore', String),
+        Column('brand', String),
+        Column('destinazione', String),
+        Column('immagine', String),
+        Column('immagine2', String),
+        Column('created_at', String),   # opzionale ma utile in header
+        Column('quantita', Integer, nullable=False, default=1, server_default='1')
+    )
+    metadata.create_all(engine)
+    invalida_tabella(nome_tabella)
+    return nome_tabella
+
+
+# Registro process-wide delle tabelle wardrobe già riflesse: la riflessione
+# (information_schema / sqlite_master) si fa una volta sola per tabella e non
+# a ogni richiesta. Va invalidato quando lo schema di una tabella cambia.
+_tabelle_riflesse: dict[str, Table] = {}
+_tabelle_lock = threading.Lock()
+
+
+def get_tabella(nome_tabella: str) -> Table:
+    """
+    Ritorna la Table del wardrobe dal registro, riflettendola dal DB solo
+    al primo accesso. Solleva NoSuchTableError se la tabella non esiste.
+    """
+    tbl = _tabelle_riflesse.get(nome_tabella)
+    if tbl is not None:
+        return tbl
+
+    with _tabelle_lock:
+        tbl = _tabelle_riflesse.get(nome_tabella)
+        if tbl is None:
+            tbl = Table(nome_tabella, MetaData(), autoload_with=engine)
+            _tabelle_riflesse[nome_tabella] = tbl
+    return tbl
+
+
+def invalida_tabella(nome_tabella: str) -> None:
+    """Toglie la tabella dal registro (creata, droppata o modificata)."""
+    with _tabelle_lock:
+        _tabelle_riflesse.pop(nome_tabella, None)
+
+
+def tabella_capi(w: Wardrobe):
+    """
+    Ritorna (tabella, filtro) per leggere/scrivere i capi del wardrobe `w`:
+    con lo storage condiviso è la tabella `capi` filtrata per wardrobe_id,
+    altrimenti la tabella fisica del wardrobe (filtro sempre vero).
+    """
+    if STORAGE_CONDIVISO:
+        tbl = Capo.__table__
+        return tbl, tbl.c.wardrobe_id == w.id
+    return get_tabella(w.nome), true()
+
+
+def valori_capo(w: Wardrobe, values: dict) -> dict:
+    """Valori da inserire per un nuovo capo di `w` (con wardrobe_id se serve)."""
+    if STORAGE_CONDIVISO:
+        return {**values, 'wardrobe_id': w.id}
+    return values
+
+
+def ultimo_inserimento(conn, w: Wardrobe):
+    """created_at più recente dei capi di `w` (None se vuoto o senza colonna)."""
+    tbl, filtro = tabella_capi(w)
+    if 'created_at' not in tbl.c:
+        return None
+    return conn.execute(select(func.max(tbl.c.created_at)).where(filtro)).scalar()
+
+
+def tocca_wardrobe(conn, wardrobe_id: int, **values) -> None:
+    """
+    Incrementa wardrobes.versione (più eventuali altri `values`) nella
+    transazione `conn`. Ogni scrittura sui capi di un wardrobe passa da qui,
+    altrimenti le pagine del wardrobe risponderebbero 304 con dati vecchi.
+    """
+    wardrobes = Wardrobe.__table__
+    conn.execute(
+        wardrobes.update()
+                 .where(wardrobes.c.id == wardrobe_id)
+                 .values(versione=wardrobes.c.versione + 1, **values)
+    )
+    if has_app_context():
+        g.get('versioni_wardrobe', {}).pop(wardrobe_id, None)
+
+
+def aggiorna_ultimo_inserimento(conn, w: Wardrobe) -> None:
+    """
+    Ricalcola wardrobes.last_added_at (created_at più recente dei capi di
+    `w`) e incrementa wardrobes.versione nella transazione `conn`. Va
+    chiamata dalle route che aggiungono, modificano o tolgono capi, seguita
+    da cache_header.invalida(user_id).
+    """
+    tocca_wardrobe(conn, w.id, last_added_at=ultimo_inserimento(conn, w))
+
+
+def stesso_capo(tbl, capo: dict) -> list:
+    """Condizioni WHERE della riga con gli stessi CHIAVE_CATALOGO di `capo`."""
+    return [
+        tbl.c[c].is_(None) if capo.get(c) is None else tbl.c[c] == capo[c]
+        for c in CHIAVE_CATALOGO
+    ]
+
+
+def aggiungi_pezzi(conn, w: Wardrobe, capo: dict, n: int) -> int:
+    """
+    Aggiunge `n` pezzi di `capo` al wardrobe nella transazione `conn`:
+    se il capo c'è già incrementa la sua quantita (UPDATE atomico),
+    altrimenti inserisce la riga. Aggiorna anche il catalogo.
+    Ritorna l'id della riga.
+    """
+    tbl, filtro = tabella_capi(w)
+    capo_id = conn.execute(
+        select(tbl.c.id).where(filtro, *stesso_capo(tbl, capo)).order_by(tbl.c.id).limit(1)
+    ).scalar()
+
+    if capo_id is None:
+        capo_id = conn.execute(
+            tbl.insert().values(**valori_capo(w, {**capo, 'quantita': n}))
+        ).inserted_primary_key[0]
+    else:
+        values = {'quantita': tbl.c.quantita + n}
+        if capo.get('created_at'):
+            values['created_at'] = capo['created_at']
+        conn.execute(tbl.update().where(tbl.c.id == capo_id).values(**values))
+
+    aggiorna_catalogo(conn, capo, n)
+    return capo_id
+
+
+def togli_pezzi(conn, w: Wardrobe, capo_id: int, n: int) -> int:
+    """
+    Toglie fino a `n` pezzi dalla riga `capo_id` nella transazione `conn`
+    (la riga resta bloccata fino al commit); a 0 pezzi la riga viene
+    cancellata. Aggiorna anche il catalogo. Ritorna i pezzi tolti.
+    """
+    tbl, filtro = tabella_capi(w)
+    dove = (filtro, tbl.c.id == capo_id)
+    riga = conn.execute(tbl.select().where(*dove).with_for_update()).first()
+    if riga is None:
+        return 0
+
+    capo = dict(riga._mapping)
+    tolti = min(n, capo['quantita'])
+    if tolti < capo['quantita']:
+        conn.execute(tbl.update().where(*dove).values(quantita=tbl.c.quantita - tolti))
+    else:
+        conn.execute(tbl.delete().where(*dove))
+
+    aggiorna_catalogo(conn, capo, -tolti)
+    return tolti
+
+
+def migra_capi_condivisi(batch: int = 500) -> int:
+    """
+    Copia a blocchi di `batch` righe i capi dalle tabelle wardrobe_<username>
+    alla tabella unica `capi`, senza fermare il sito. È idempotente: rilanciata
+    riallinea inserimenti, modifiche e cancellazioni avvenuti nel frattempo
+    (va rilanciata subito prima di passare a WARDROBE_STORAGE=condiviso).
+    Ritorna il numero di righe scritte.
+    """
+    capi = Capo.__table__
+    campi = CHIAVE_CATALOGO + ('created_at', 'quantita')
+    existing_tables = set(inspect(engine).get_table_names())
+    scritte = 0
+
+    for w in db_session.query(Wardrobe).order_by(Wardrobe.id).all():
+        if w.nome not in existing_tables:
+            continue
+        src = get_tabella(w.nome)
+        ultimo = 0
+
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(
+                    src.select().where(src.c.id > ultimo).order_by(src.c.id).limit(batch)
+                ).fetchall()
+
+                # righe già copiate nello stesso intervallo di id
+                intervallo = [capi.c.wardrobe_id == w.id, capi.c.legacy_id > ultimo]
+                if rows:
+                    intervallo.append(capi.c.legacy_id <= rows[-1].id)
+                copiate = {
+                    r.legacy_id: r._mapping
+                    for r in conn.execute(capi.select().where(*intervallo))
+                }
+
+                scritte_prima = scritte
+                nuove = []
+                for row in rows:
+                    rd = row._mapping
+                    values = {c: rd.get(c) for c in campi}
+                    esistente = copiate.pop(rd['id'], None)
+                    if esistente is None:
+                        nuove.append({**values, 'wardrobe_id': w.id, 'legacy_id': rd['id']})
+                    elif any(esistente[c] != values[c] for c in campi):
+                        conn.execute(
+                            capi.update().where(capi.c.id == esistente['id']).values(**values)
+                        )
+                        scritte += 1
+
+                if nuove:
+                    conn.execute(capi.insert(), nuove)
+                    scritte += len(nuove)
+
+                # cancellate dalla tabella sorgente dopo la copia precedente
+                if copiate:
+                    conn.execute(capi.delete().where(
+                        capi.c.id.in_([r['id'] for r in copiate.values()])
+                    ))
+                    scritte += len(copiate)
+
+                if scritte > scritte_prima:
+                    tocca_wardrobe(conn, w.id)
+
+            if not rows:
+                break
+            ultimo = rows[-1].id
+
+    return scritte
+
+
+def compatta_capi(batch: int = 500) -> int:
+    """
+    Fonde le righe duplicate (stessi CHIAVE_CATALOGO nello stesso wardrobe)
+    create quando ogni pezzo era una riga: resta la riga con l'id più basso,
+    con la somma delle quantita e il created_at più recente. Lavora sia sulle
+    tabelle wardrobe_<username> sia su `capi`, a blocchi di `batch` gruppi
+    per transazione. Il catalogo non cambia (i pezzi totali sono gli stessi).
+    Ritorna il numero di righe eliminate.
+    """
+    esistenti = set(inspect(engine).get_table_names())
+    # (tabella, colonne di raggruppamento in più, wardrobe della tabella)
+    tabelle = [
+        (get_tabella(w.nome), [], w.id)
+        for w in db_session.query(Wardrobe).order_by(Wardrobe.id).all()
+        if w.nome in esistenti
+    ]
+    capi = Capo.__table__
+    tabelle.append((capi, [capi.c.wardrobe_id], None))
+
+    eliminate = 0
+    for tbl, extra, wardrobe_id in tabelle:
+        cols = [tbl.c[c] for c in CHIAVE_CATALOGO] + extra
+        with engine.connect() as conn:
+            gruppi = conn.execute(
+                select(*cols).group_by(*cols).having(func.count() > 1)
+            ).fetchall()
+
+        for i in range(0, len(gruppi), batch):
+            with engine.begin() as conn:
+                for g in gruppi[i:i + batch]:
+                    gd = g._mapping
+                    dove = stesso_capo(tbl, gd) + [c == gd[c.name] for c in extra]
+                    # righe del gruppo bloccate: nessun incremento va perso
+                    righe = conn.execute(
+                        select(tbl.c.id, tbl.c.quantita, tbl.c.created_at)
+                        .where(*dove).order_by(tbl.c.id).with_for_update()
+                    ).fetchall()
+                    if len(righe) < 2:
+                        continue
+                    conn.execute(
+                        tbl.update().where(tbl.c.id == righe[0].id).values(
+                            quantita=sum(r.quantita for r in righe),
+                            created_at=max((r.created_at or '' for r in righe), default='') or None
+                        )
+                    )
+                    conn.execute(tbl.delete().where(tbl.c.id.in_([r.id for r in righe[1:]])))
+                    tocca_wardrobe(conn, wardrobe_id or gd['wardrobe_id'])
+                    eliminate += len(righe) - 1
+
+    return eliminate
+
+
+def get_personal_wardrobe(user) -> "WardrobeRif":
+    """
+    Restituisce (o crea) il wardrobe personale dell'utente (User o Identita),
+    con nome: wardrobe_<username_normalizzato>
+    """
+    raw_name = f"wardrobe_{user.username}"
+    nome_tabella = re.sub(r'\W+', '_', raw_name.lower())
+
+    ident = carica_identita(user.id)
+    w = ident.wardrobes.get(nome_tabella) if ident else None
+
+    if not w:
+        # crea tabella fisica (solo con lo storage per utente)
+        if not STORAGE_CONDIVISO:
+            crea_tabella_wardrobe(nome_tabella)
+        # registra nel DB master
+        nuovo = Wardrobe(nome=nome_tabella, user_id=user.id)
+        db_session.add(nuovo)
+        db_session.commit()
+        invalida_identita(user.id)
+        w = WardrobeRif(nuovo.id, nuovo.nome, nuovo.user_id)
+
+    return w
+
+
+# ----------------------------
+#       MIGRAZIONI SCHEMA
+# ----------------------------
+
+# Ogni migrazione porta lo schema dalla versione precedente alla sua ed è
+# idempotente (i DB nati prima di schema_version partono da 0 e le
+# rieseguono tutte). Si applicano con `flask db upgrade`; all'avvio ogni
+# worker fa solo il controllo della versione (una query). Se il DB è
+# indietro e MIGRAZIONI_AUTOMATICHE=1 (default) migra il primo processo
+# che prende il lock, gli altri aspettano e trovano lo schema già a posto.
+MIGRAZIONI_AUTOMATICHE = os.environ.get("MIGRAZIONI_AUTOMATICHE", "1") == "1"
+# chiave dell'advisory lock di Postgres (numero arbitrario, fisso)
+LOCK_MIGRAZIONI_PG = 7305202501
+
+try:
+    import fcntl
+except ImportError:  # Windows: sviluppo locale a processo singolo
+    fcntl = None
+
+
+def _migrazione_schema_iniziale():
+    """Tabelle dei modelli; su Postgres toglie users/wardrobes del vecchio schema."""
     if engine.dialect.name == "postgresql":
         with engine.begin() as conn:
             # ---- Tabella USERS ----
@@ -140,116 +1766,660 @@ def ensure_schema():
                       AND column_name = 'password_hash'
                 """)).first() is not None
 
-                if not has_password_hash:
-                    conn.execute(text("DROP TABLE users CASCADE"))
+                if not has_password_hash:
+                    conn.execute(text("DROP TABLE users CASCADE"))
+
+            # ---- Tabella WARDROBES ----
+            wardrobes_exists = conn.execute(text("""
+                SELECT 1
+                FROM information_schema.tables
+                WHERE table_name = 'wardrobes'
+            """)).first() is not None
+
+            if wardrobes_exists:
+                has_user_id = conn.execute(text("""
+                    SELECT 1
+                    FROM information_schema.columns
+                    WHERE table_name = 'wardrobes'
+                      AND column_name = 'user_id'
+                """)).first() is not None
+
+                if not has_user_id:
+                    conn.execute(text("DROP TABLE wardrobes CASCADE"))
+
+    # il catalogo pubblico è derivato dai wardrobe: se lo schema è vecchio
+    # lo ricreo (lo ripopola la migrazione dell'indice di ricerca)
+    inspector = inspect(engine)
+    if inspector.has_table('catalogo_pubblico'):
+        colonne = {c['name'] for c in inspector.get_columns('catalogo_pubblico')}
+        if 'versione' not in colonne:
+            CatalogoCapo.__table__.drop(engine)
+
+    BaseMaster.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        ver = CatalogoVersione.__table__
+        if conn.execute(select(ver.c.id).where(ver.c.id == 1)).first() is None:
+            conn.execute(ver.insert().values(id=1, versione=0, ricostruzione=0))
+
+
+def _migrazione_quantita():
+    """
+    Aggiunge la colonna `quantita` (default 1: ogni riga vecchia è un pezzo)
+    a `capi` e alle tabelle wardrobe_<username> che non ce l'hanno ancora.
+    Le righe duplicate le fonde la migrazione 8.
+    """
+    inspector = inspect(engine)
+    esistenti = set(inspector.get_table_names())
+    with engine.connect() as conn:
+        nomi = [r.nome for r in conn.execute(select(Wardrobe.__table__.c.nome))]
+
+    quote = engine.dialect.identifier_preparer.quote
+    for nome in ['capi'] + nomi:
+        if nome not in esistenti:
+            continue
+        if 'quantita' in {c['name'] for c in inspector.get_columns(nome)}:
+            continue
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE {quote(nome)} ADD COLUMN quantita INTEGER NOT NULL DEFAULT 1"
+            ))
+        invalida_tabella(nome)
+
+
+def _migrazione_ultimo_inserimento():
+    """
+    Colonna wardrobes.last_added_at, riempita dai capi esistenti. Il
+    riempimento tocca solo le righe ancora NULL e gira anche se la colonna
+    c'è già: se si interrompe, la migrazione rilanciata lo completa.
+    """
+    if 'last_added_at' not in {c['name'] for c in inspect(engine).get_columns('wardrobes')}:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE wardrobes ADD COLUMN last_added_at VARCHAR"))
+
+    # solo colonne che esistono a questo punto della catena: wardrobes.versione
+    # arriva con la migrazione 7, quindi niente aggiorna_ultimo_inserimento
+    tbl = Wardrobe.__table__
+    with engine.connect() as conn:
+        wardrobes = conn.execute(
+            select(tbl.c.id, tbl.c.nome, tbl.c.user_id).where(tbl.c.last_added_at.is_(None))
+        ).fetchall()
+    for w in wardrobes:
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    tbl.update().where(tbl.c.id == w.id, tbl.c.last_added_at.is_(None))
+                       .values(last_added_at=ultimo_inserimento(conn, w))
+                )
+        except NoSuchTableError:
+            continue
+
+
+def _migrazione_registro_immagini():
+    """Colonne del registro immagini usate dal garbage collector."""
+    colonne = {c['name'] for c in inspect(engine).get_columns('immagini_file')}
+    with engine.begin() as conn:
+        for nome, tipo in (('usato_at', 'VARCHAR'), ('riferimenti', 'INTEGER'), ('contati_at', 'VARCHAR')):
+            if nome not in colonne:
+                conn.execute(text(f"ALTER TABLE immagini_file ADD COLUMN {nome} {tipo}"))
+
+
+def _migrazione_prenotazioni():
+    """Tabella dei noleggi (prenotazioni per intervallo di date)."""
+    Prenotazione.__table__.create(engine, checkfirst=True)
+
+
+def _migrazione_versione_wardrobe():
+    """wardrobes.versione per gli ETag delle pagine del wardrobe."""
+    colonne = {c['name'] for c in inspect(engine).get_columns('wardrobes')}
+    if 'versione' not in colonne:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE wardrobes ADD COLUMN versione INTEGER NOT NULL DEFAULT 0"))
+
+
+def _migrazione_compatta_capi():
+    """
+    Fonde i capi duplicati (un pezzo per riga) in una riga con la quantita.
+    Idempotente: senza duplicati non scrive nulla; `flask compatta-capi`
+    resta per rilanciarla a mano.
+    """
+    n = compatta_capi()
+    if n:
+        print(f"{n} righe duplicate fuse.")
+
+
+def _migrazione_catalogo_e_ricerca():
+    """Indice full-text; catalogo pubblico (ri)popolato se vuoto."""
+    with engine.begin() as conn:
+        crea_indice_ricerca(conn)
+        catalogo_vuoto = conn.execute(select(CatalogoCapo.id).limit(1)).first() is None
+        if not catalogo_vuoto and indice_ricerca_vuoto(conn):
+            # catalogo già popolato ma indice full-text appena creato
+            reindicizza_ricerca(conn)
+    if catalogo_vuoto:
+        ricostruisci_catalogo()
+
+
+# (versione, descrizione, funzione), in ordine: non rinumerare né togliere
+MIGRAZIONI = (
+    (1, "schema iniziale", _migrazione_schema_iniziale),
+    (2, "colonna quantita dei capi", _migrazione_quantita),
+    (3, "wardrobes.last_added_at", _migrazione_ultimo_inserimento),
+    (4, "indice full-text e catalogo pubblico", _migrazione_catalogo_e_ricerca),
+    (5, "registro immagini per il garbage collector", _migrazione_registro_immagini),
+    (6, "prenotazioni dei noleggi", _migrazione_prenotazioni),
+    (7, "wardrobes.versione", _migrazione_versione_wardrobe),
+    (8, "capi duplicati fusi in una riga con la quantita", _migrazione_compatta_capi),
+)
+VERSIONE_SCHEMA = MIGRAZIONI[-1][0]
+
+
+def versione_schema() -> int:
+    """Versione applicata al DB (0 se schema_version non esiste ancora)."""
+    tbl = SchemaVersione.__table__
+    try:
+        with engine.connect() as conn:
+            versione = conn.execute(select(tbl.c.versione).where(tbl.c.id == 1)).scalar()
+    except Exception:
+        return 0
+    return versione or 0
+
+
+class lock_migrazioni:
+    """
+    Un solo processo alla volta migra: advisory lock su Postgres, lock su
+    file accanto al DB con SQLite. Bloccante: gli altri aspettano.
+    """
+
+    def __enter__(self):
+        self._conn = self._file = None
+        if engine.dialect.name == 'postgresql':
+            self._conn = engine.connect()
+            self._conn.execute(text("SELECT pg_advisory_lock(:k)"), {'k': LOCK_MIGRAZIONI_PG})
+        elif engine.dialect.name == 'sqlite' and fcntl is not None:
+            database = engine.url.database
+            if database and database != ':memory:':
+                self._file = open(os.path.abspath(database) + '.migrazioni.lock', 'w')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._conn is not None:
+            self._conn.execute(text("SELECT pg_advisory_unlock(:k)"), {'k': LOCK_MIGRAZIONI_PG})
+            self._conn.close()
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def aggiorna_schema(verbose: bool = False) -> list[int]:
+    """
+    Applica le migrazioni mancanti, registrando la versione dopo ognuna.
+    Ritorna le versioni applicate (nessuna se lo schema era già aggiornato).
+    """
+    applicate = []
+    with lock_migrazioni():
+        # riletta sotto lock: un altro processo può aver appena migrato
+        SchemaVersione.__table__.create(engine, checkfirst=True)
+        attuale = versione_schema()
+        tbl = SchemaVersione.__table__
+        for versione, descrizione, migrazione in MIGRAZIONI:
+            if versione <= attuale:
+                continue
+            if verbose:
+                print(f"Migrazione {versione}: {descrizione}...")
+            migrazione()
+            with engine.begin() as conn:
+                valori = {'versione': versione, 'aggiornato': datetime.now(timezone.utc).isoformat()}
+                if not conn.execute(tbl.update().where(tbl.c.id == 1).values(**valori)).rowcount:
+                    conn.execute(tbl.insert().values(id=1, **valori))
+            applicate.append(versione)
+    return applicate
+
+
+# avvio: una query per la versione; si migra solo se serve
+try:
+    SCHEMA_DA_AGGIORNARE = versione_schema() < VERSIONE_SCHEMA
+    if SCHEMA_DA_AGGIORNARE and MIGRAZIONI_AUTOMATICHE:
+        aggiorna_schema(verbose=True)
+        SCHEMA_DA_AGGIORNARE = False
+    elif SCHEMA_DA_AGGIORNARE:
+        print("Schema del DB non aggiornato: esegui `flask db upgrade`.")
+finally:
+    # nessuna transazione né connessione aperta dopo l'import: con
+    # gunicorn --preload i worker nascono da qui, e su Postgres una sessione
+    # "idle in transaction" terrebbe i lock sulle tabelle (DROP, migrazioni)
+    db_session.remove()
+    engine.dispose()
+_controllo_schema = {'ultimo': time.monotonic()}
+
+
+@app.before_request
+def schema_aggiornato():
+    """Con lo schema indietro (e niente migrazioni automatiche) risponde 503."""
+    global SCHEMA_DA_AGGIORNARE
+    if not SCHEMA_DA_AGGIORNARE:
+        return None
+    if time.monotonic() - _controllo_schema['ultimo'] > 5:
+        _controllo_schema['ultimo'] = time.monotonic()
+        SCHEMA_DA_AGGIORNARE = versione_schema() < VERSIONE_SCHEMA
+        if not SCHEMA_DA_AGGIORNARE:
+            return None
+    return Response("Aggiornamento del database in corso, riprova tra poco.\n",
+                    status=503, mimetype='text/plain', headers={'Retry-After': '30'})
+
+
+# ----------------------------
+#       CODA LAVORI
+# ----------------------------
+
+# Coda locale nel DB (tabella lavori), senza broker esterni. LAVORI_MODALITA:
+# - "thread":   ogni processo web esegue i lavori in LAVORI_THREAD thread
+# - "esterno":  i processi web accodano soltanto, li esegue `flask worker`
+# - "sincrono": eseguiti subito da chi li accoda (test, una sola macchina)
+LAVORI_MODALITA = os.environ.get("LAVORI_MODALITA", "thread")
+LAVORI_THREAD = int(os.environ.get("LAVORI_THREAD", "1"))
+LAVORI_MAX_TENTATIVI = 3
+# un lavoro in_corso da più di così è di un worker morto: torna in coda
+LAVORI_TIMEOUT = int(os.environ.get("LAVORI_TIMEOUT", "600"))
+INTERVALLO_POLL_LAVORI = 2.0
+
+GESTORI_LAVORI = {}
+_worker_lavori = {'pid': None, 'sveglia': threading.Event(), 'lock': threading.Lock()}
+
+
+def gestore_lavoro(tipo: str):
+    """Registra la funzione che esegue i lavori di tipo `tipo` (kwargs = argomenti)."""
+    def decorator(fn):
+        GESTORI_LAVORI[tipo] = fn
+        return fn
+    return decorator
+
+
+@gestore_lavoro('derivati')
+def _lavoro_derivati(nome: str) -> None:
+    genera_derivati(app.config['UPLOAD_FOLDER'], nome)
+
+
+def accoda_lavoro(tipo: str, **argomenti) -> None:
+    """
+    Accoda un lavoro. Con LAVORI_MODALITA=sincrono lo esegue subito; un
+    errore non si propaga a chi accoda (resta registrato nella coda).
+    Da un comando `flask ...` in modalità thread la coda viene svuotata
+    prima di uscire: i thread daemon morirebbero con il processo.
+    """
+    lav = Lavoro.__table__
+    ora = time.time()
+    with engine.begin() as conn:
+        lavoro_id = conn.execute(lav.insert().values(
+            tipo=tipo,
+            argomenti=json.dumps(argomenti),
+            stato='in_coda',
+            tentativi=0,
+            esegui_dopo=0,
+            aggiornato=ora,
+            created_at=datetime.now(timezone.utc).isoformat()
+        )).inserted_primary_key[0]
+
+    if LAVORI_MODALITA == 'sincrono':
+        if _prendi_lavoro(lavoro_id):
+            _esegui_lavoro(lavoro_id, tipo, argomenti, 0)
+    elif LAVORI_MODALITA == 'thread':
+        ctx = None if has_request_context() else click.get_current_context(silent=True)
+        if ctx is None:
+            avvia_worker_lavori()
+            _worker_lavori['sveglia'].set()
+        elif not ctx.find_root().meta.get('stycly.svuota_coda'):
+            ctx.find_root().meta['stycly.svuota_coda'] = True
+            ctx.find_root().call_on_close(svuota_coda_lavori)
+
+
+def _prendi_lavoro(lavoro_id: int) -> bool:
+    """Passa il lavoro a in_corso se è ancora in coda (un solo worker vince)."""
+    lav = Lavoro.__table__
+    with engine.begin() as conn:
+        return bool(conn.execute(
+            lav.update()
+               .where(lav.c.id == lavoro_id, lav.c.stato == 'in_coda')
+               .values(stato='in_corso', aggiornato=time.time())
+        ).rowcount)
+
+
+def _prossimo_lavoro():
+    """Prende il primo lavoro eseguibile; None se la coda è vuota."""
+    lav = Lavoro.__table__
+    while True:
+        with engine.connect() as conn:
+            riga = conn.execute(
+                select(lav.c.id, lav.c.tipo, lav.c.argomenti, lav.c.tentativi)
+                .where(lav.c.stato == 'in_coda', lav.c.esegui_dopo <= time.time())
+                .order_by(lav.c.id)
+                .limit(1)
+            ).first()
+        if riga is None:
+            return None
+        if _prendi_lavoro(riga.id):
+            return riga
+        # preso da un altro worker nel frattempo: provo il successivo
+
+
+def _esegui_lavoro(lavoro_id: int, tipo: str, argomenti: dict, tentativi: int) -> None:
+    """
+    Esegue un lavoro preso in carico. Riuscito: la riga viene eliminata.
+    Fallito: torna in coda con attesa crescente, fino a LAVORI_MAX_TENTATIVI.
+    """
+    lav = Lavoro.__table__
+    try:
+        GESTORI_LAVORI[tipo](**argomenti)
+    except Exception as e:
+        print("Errore lavoro:", lavoro_id, tipo, e)
+        tentativi += 1
+        esaurito = tentativi >= LAVORI_MAX_TENTATIVI
+        with engine.begin() as conn:
+            conn.execute(lav.update().where(lav.c.id == lavoro_id).values(
+                stato='errore' if esaurito else 'in_coda',
+                tentativi=tentativi,
+                esegui_dopo=time.time() + 10 * 2 ** tentativi,
+                aggiornato=time.time(),
+                errore=str(e)[:500]
+            ))
+        return
+
+    with engine.begin() as conn:
+        conn.execute(lav.delete().where(lav.c.id == lavoro_id))
+
+
+def recupera_lavori_bloccati() -> int:
+    """Rimette in coda i lavori in_corso da più di LAVORI_TIMEOUT secondi."""
+    lav = Lavoro.__table__
+    with engine.begin() as conn:
+        return conn.execute(
+            lav.update()
+               .where(lav.c.stato == 'in_corso', lav.c.aggiornato < time.time() - LAVORI_TIMEOUT)
+               .values(stato='in_coda', aggiornato=time.time())
+        ).rowcount
+
+
+def esegui_lavori(fermati_se_vuota: bool = False) -> int:
+    """
+    Ciclo del worker: esegue i lavori in coda, poi aspetta di essere
+    svegliato (lavoro accodato da questo processo) o il prossimo poll
+    (lavori accodati da altri processi). Ritorna quanti ne ha eseguiti.
+    """
+    eseguiti = 0
+    ultimo_recupero = 0.0
+    while True:
+        try:
+            if time.time() - ultimo_recupero > 60:
+                ultimo_recupero = time.time()
+                recupera_lavori_bloccati()
+
+            riga = _prossimo_lavoro()
+            if riga is not None:
+                _esegui_lavoro(riga.id, riga.tipo, json.loads(riga.argomenti), riga.tentativi)
+                eseguiti += 1
+                continue
+        except Exception as e:
+            print("Errore worker lavori:", e)
+
+        if fermati_se_vuota:
+            return eseguiti
+        _worker_lavori['sveglia'].wait(INTERVALLO_POLL_LAVORI)
+        _worker_lavori['sveglia'].clear()
+
+
+def svuota_coda_lavori() -> None:
+    """Alla fine di un comando CLI: esegue i lavori rimasti in coda."""
+    n = esegui_lavori(fermati_se_vuota=True)
+    if n:
+        print(f"{n} lavori in coda eseguiti.")
+
+
+def avvia_worker_lavori() -> None:
+    """
+    Avvia (una volta per processo) i thread worker. Partono al primo lavoro
+    accodato, cioè dopo il fork dei worker gunicorn: i thread non
+    sopravvivono al fork.
+    """
+    if _worker_lavori['pid'] == os.getpid():
+        return
+    with _worker_lavori['lock']:
+        if _worker_lavori['pid'] == os.getpid():
+            return
+        _worker_lavori['pid'] = os.getpid()
+        _worker_lavori['sveglia'] = threading.Event()
+        for i in range(LAVORI_THREAD):
+            threading.Thread(target=esegui_lavori, name=f"lavori-{i}", daemon=True).start()
+
+
+def immagini_in_lavorazione() -> set:
+    """
+    Nomi delle immagini di cui la coda sta ancora generando i derivati
+    (una query per richiesta, memorizzata in g).
+    """
+    if 'immagini_in_lavorazione' not in g:
+        lav = Lavoro.__table__
+        with engine.connect() as conn:
+            righe = conn.execute(
+                select(lav.c.argomenti)
+                .where(lav.c.tipo == 'derivati', lav.c.stato.in_(('in_coda', 'in_corso')))
+            ).scalars().all()
+        g.immagini_in_lavorazione = {json.loads(a).get('nome') for a in righe}
+    return g.immagini_in_lavorazione
+
+
+@app.template_global()
+def in_lavorazione(filename) -> bool:
+    """True se i derivati dell'immagine non sono ancora pronti."""
+    return bool(filename) and filename.split('/')[-1] in immagini_in_lavorazione()
+
+
+# ----------------------------
+#       TASSONOMIA (form_data.json)
+# ----------------------------
+
+# ogni quanto (secondi) controllare se form_data.json è cambiato su disco
+INTERVALLO_CONTROLLO_TASSONOMIA = float(os.environ.get("INTERVALLO_CONTROLLO_TASSONOMIA", "1.0"))
+
+# campo del capo -> chiave della lista di valori ammessi in form_data.json
+CAMPI_TASSONOMIA = {
+    'brand': 'brands',
+    'destinazione': 'destinazioni',
+    'taglia': 'taglie',
+    'fit': 'fit',
+    'colore': 'colori',
+}
+
+
+class Tassonomia:
+    """
+    Le opzioni dei form (static/data/form_data.json), lette una volta e
+    ricaricate solo se il file cambia (mtime/dimensione). Al caricamento
+    precalcola gli insiemi dei valori ammessi, così la validazione di un
+    capo è fatta di lookup O(1), e la versione (hash del contenuto) usata
+    come ETag da /api/taxonomy.
+    """
+
+    def __init__(self, percorso: str):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self._firma = None
+        self._ultimo_controllo = 0.0
+        self.dati = {}
+        self.versione = ''
+        self.json = b'{}'
+        self._tipologie = {}    # categoria -> frozenset(tipologie)
+        self._ammessi = {}      # campo -> frozenset(valori)
+
+    def _aggiorna(self) -> None:
+        adesso = time.monotonic()
+        if self._firma is not None and adesso - self._ultimo_controllo < INTERVALLO_CONTROLLO_TASSONOMIA:
+            return
+
+        with self._lock:
+            self._ultimo_controllo = adesso
+            try:
+                st = os.stat(self.percorso)
+                firma = (st.st_mtime_ns, st.st_size)
+                if firma == self._firma:
+                    return
+                with open(self.percorso, 'rb') as f:
+                    raw = f.read()
+                dati = json.loads(raw)
+            except Exception as e:
+                # teniamo l'ultima versione buona (se c'è)
+                print("Errore lettura form_data.json:", e)
+                return
+
+            self.dati = dati
+            self.versione = hashlib.sha1(raw).hexdigest()[:12]
+            self.json = json.dumps(
+                {'versione': self.versione, **dati},
+                ensure_ascii=False, separators=(',', ':')
+            ).encode('utf-8')
+            self._tipologie = {
+                cat: frozenset(tipi) for cat, tipi in (dati.get('tipologie') or {}).items()
+            }
+            self._ammessi = {
+                campo: frozenset(dati.get(chiave) or ())
+                for campo, chiave in CAMPI_TASSONOMIA.items()
+            }
+            self._firma = firma
+
+    def get(self) -> dict:
+        """Il contenuto di form_data.json (da non modificare)."""
+        self._aggiorna()
+        return self.dati
 
-            # ---- Tabella WARDROBES ----
-            wardrobes_exists = conn.execute(text("""
-                SELECT 1
-                FROM information_schema.tables
-                WHERE table_name = 'wardrobes'
-            """)).first() is not None
+    def errori(self, capo: dict, precedente: dict | None = None) -> list[str]:
+        """
+        Campi del capo con valori fuori tassonomia. I valori rimasti uguali a
+        quelli di `precedente` (capi inseriti prima di una modifica del file)
+        sono accettati.
+        """
+        self._aggiorna()
+        precedente = precedente or {}
 
-            if wardrobes_exists:
-                has_user_id = conn.execute(text("""
-                    SELECT 1
-                    FROM information_schema.columns
-                    WHERE table_name = 'wardrobes'
-                      AND column_name = 'user_id'
-                """)).first() is not None
+        def invariato(campo):
+            return capo.get(campo) == precedente.get(campo)
 
-                if not has_user_id:
-                    conn.execute(text("DROP TABLE wardrobes CASCADE"))
+        errori = []
+        tipi = self._tipologie.get(capo.get('categoria'))
+        if tipi is None and not invariato('categoria'):
+            errori.append('categoria')
+        elif tipi is not None and capo.get('tipologia') not in tipi \
+                and not (invariato('categoria') and invariato('tipologia')):
+            errori.append('tipologia')
+        for campo, ammessi in self._ammessi.items():
+            if capo.get(campo) not in ammessi and not invariato(campo):
+                errori.append(campo)
+        return errori
 
-    # (ri)creiamo le tabelle secondo i modelli User/Wardrobe
-    BaseMaster.metadata.create_all(engine)
 
+tassonomia = Tassonomia(os.path.join(BASE_DIR, 'static', 'data', 'form_data.json'))
 
-# esegui la sistemazione dello schema
-ensure_schema()
 
-# sessione DB
-Session = sessionmaker(bind=engine)
-db_session = Session()
+@app.template_global()
+def url_tassonomia() -> str:
+    """URL versionato di /api/taxonomy (cambia quando cambia il file)."""
+    tassonomia.get()
+    return url_for('api_taxonomy', v=tassonomia.versione)
 
 
 # ----------------------------
-#       FUNZIONI UTILI
+#       SESSIONE / LOGIN
 # ----------------------------
 
-def allowed_file(filename: str) -> bool:
-    return (
-        '.' in filename
-        and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-    )
+# wardrobe dell'utente come serve alle route (id, nome, proprietario):
+# niente oggetti ORM nelle cache condivise tra richieste
+WardrobeRif = namedtuple('WardrobeRif', 'id nome user_id')
 
 
-def validate_password_strength(password: str) -> str | None:
-    """
-    Controlla robustezza password.
-    Ritorna messaggio di errore, oppure None se ok.
-    """
-    if len(password) < 8:
-        return "La password deve avere almeno 8 caratteri."
-    if not re.search(r"[A-Za-z]", password):
-        return "La password deve contenere almeno una lettera."
-    if not re.search(r"\d", password):
-        return "La password deve contenere almeno un numero."
-    return None
+class Identita:
+    """Utente della richiesta con i suoi wardrobe (nome -> WardrobeRif, per id)."""
 
+    __slots__ = ('id', 'username', 'email', 'wardrobes')
 
-def crea_tabella_wardrobe(nome_tabella: str) -> str:
-    """
-    Crea dinamicamente la tabella del wardrobe (per utente).
-    Colonne allineate a tutto il codice.
-    """
-    nome_tabella = re.sub(r'\W+', '_', nome_tabella.lower())
-    metadata = MetaData()
-    Table(
-        nome_tabella, metadata,
-        Column('id', Integer, primary_key=True),
-        Column('categoria', String),
-        Column('tipologia', String),
-        Column('taglia', String),
-        Column('fit', String),
-        Column('colore', String),
-        Column('brand', String),
-        Column('destinazione', String),
-        Column('immagine', String),
-        Column('immagine2', String),
-        Column('created_at', String)   # opzionale ma utile in header
-    )
-    metadata.create_all(engine)
-    return nome_tabella
+    def __init__(self, id, username, email, wardrobes):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.wardrobes = wardrobes
+
+
+# identità per user_id: TTL breve, perché gli altri worker non vedono
+# le invalidazioni fatte in questo processo. Le richieste che scrivono
+# rileggono sempre; le letture di un wardrobe ne verificano l'esistenza
+# con versione_wardrobe (vedi wardrobe_utente)
+cache_identita = CacheLRU(
+    'identita',
+    dimensione=int(os.environ.get("IDENTITY_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("IDENTITY_CACHE_TTL", "10"))
+)
 
 
-def get_personal_wardrobe(user: User) -> Wardrobe:
+def carica_identita(user_id, ricarica: bool = False) -> Identita | None:
     """
-    Restituisce (o crea) il wardrobe personale dell'utente,
-    con nome: wardrobe_<username_normalizzato>
+    Identità dell'utente dalla cache o con una sola query (users + wardrobes);
+    None se non esiste. Con `ricarica` salta la cache (e la aggiorna).
     """
-    raw_name = f"wardrobe_{user.username}"
-    nome_tabella = re.sub(r'\W+', '_', raw_name.lower())
+    ident = None if ricarica else cache_identita.get(user_id)
+    if ident is not None:
+        return ident
+
+    rows = db_session.execute(
+        select(User.id, User.username, User.email,
+               Wardrobe.id.label('wardrobe_id'), Wardrobe.nome)
+        .outerjoin(Wardrobe, Wardrobe.user_id == User.id)
+        .where(User.id == user_id)
+        .order_by(Wardrobe.id)
+    ).all()
+    if not rows:
+        cache_identita.invalida(user_id)
+        return None
+
+    ident = Identita(
+        rows[0].id, rows[0].username, rows[0].email,
+        {r.nome: WardrobeRif(r.wardrobe_id, r.nome, r.id) for r in rows if r.wardrobe_id is not None}
+    )
+    cache_identita.set(user_id, ident)
+    return ident
 
-    w = db_session.query(Wardrobe).filter_by(
-        nome=nome_tabella,
-        user_id=user.id
-    ).first()
 
-    if not w:
-        # crea tabella fisica
-        crea_tabella_wardrobe(nome_tabella)
-        # registra nel DB master
-        w = Wardrobe(nome=nome_tabella, user_id=user.id)
-        db_session.add(w)
-        db_session.commit()
+# metodi che non scrivono: possono usare l'identità in cache
+METODI_LETTURA = ('GET', 'HEAD', 'OPTIONS')
 
-    return w
 
+def identita_corrente() -> Identita | None:
+    """
+    Identità della richiesta corrente, risolta una volta sola e tenuta in g.
+    Chi scrive la rilegge dal DB: in un altro worker l'account o il wardrobe
+    possono essere stati eliminati dopo che questo li ha messi in cache.
+    """
+    if 'identita' not in g:
+        user_id = session.get('user_id')
+        ricarica = request.method not in METODI_LETTURA
+        g.identita = carica_identita(user_id, ricarica) if user_id else None
+    return g.identita
+
+
+def invalida_identita(user_id) -> None:
+    """Da chiamare quando cambiano l'utente o i suoi wardrobe."""
+    cache_identita.invalida(user_id)
+    if has_app_context():
+        g.pop('identita', None)
+
+
+def wardrobe_utente(nome_tabella: str) -> WardrobeRif | None:
+    """Il wardrobe `nome_tabella` se appartiene all'utente della richiesta."""
+    ident = identita_corrente()
+    w = ident.wardrobes.get(nome_tabella) if ident else None
+    if w is not None and request.method in METODI_LETTURA and versione_wardrobe(w) is None:
+        # eliminato da un altro worker: l'identità in cache è vecchia
+        invalida_identita(ident.id)
+        return None
+    return w
 
-# ----------------------------
-#       SESSIONE / LOGIN
-# ----------------------------
 
 def login_required(view_func):
     """Decorator per proteggere le route: richiede utente loggato, sessione non scaduta e utente esistente."""
@@ -262,9 +2432,8 @@ def login_required(view_func):
             flash("Devi fare login per accedere a questa pagina.", "error")
             return redirect(url_for("home"))
 
-        # Controllo che l'utente esista ancora nel DB
-        user = db_session.query(User).get(user_id)
-        if not user:
+        # Controllo che l'utente esista ancora (identità in cache: al più una query)
+        if identita_corrente() is None:
             session.clear()
             flash("La tua sessione non è più valida. Effettua di nuovo il login.", "error")
             return redirect(url_for("home"))
@@ -335,24 +2504,96 @@ def register():
     return redirect(url_for('home'))
 
 
+# ----------------------------
+# limite ai tentativi di login: token bucket nel DB (tabella login_limiti),
+# consultato PRIMA di check_password_hash, che è volutamente costoso.
+# Ogni tentativo consuma un gettone per IP e uno per account; i gettoni
+# si ricaricano in modo continuo (massimo gettoni per finestra).
+LIMITI_LOGIN = {
+    'ip': (
+        int(os.environ.get("LOGIN_MAX_IP", "30")),
+        float(os.environ.get("LOGIN_FINESTRA_IP", "600")),
+    ),
+    'account': (
+        int(os.environ.get("LOGIN_MAX_ACCOUNT", "5")),
+        float(os.environ.get("LOGIN_FINESTRA_ACCOUNT", "600")),
+    ),
+}
+_pulizia_limiti = {'ultima': 0.0}
+
+
+def consuma_gettone_login(tipo: str, chiave: str) -> bool:
+    """
+    Consuma un gettone dal bucket `tipo` ('ip' o 'account') della chiave.
+    Ritorna False se il bucket è vuoto: il tentativo va respinto.
+    Refill e consumo stanno in un unico UPDATE, quindi due worker non
+    possono spendere lo stesso gettone.
+    """
+    capacita, finestra = LIMITI_LOGIN[tipo]
+    ricarica = capacita / finestra
+    tbl = LoginLimite.__table__
+    chiave = f"{tipo}:{chiave}"
+    ora = time.time()
+
+    disponibili = tbl.c.gettoni + (ora - tbl.c.aggiornato) * ricarica
+    disponibili = case((disponibili > capacita, capacita), else_=disponibili)
+    aggiorna = (
+        tbl.update()
+           .where(tbl.c.chiave == chiave, disponibili >= 1)
+           .values(gettoni=disponibili - 1, aggiornato=ora)
+    )
+
+    with engine.begin() as conn:
+        if conn.execute(aggiorna).rowcount:
+            return True
+        try:
+            with conn.begin_nested():
+                conn.execute(tbl.insert().values(
+                    chiave=chiave, gettoni=capacita - 1, aggiornato=ora
+                ))
+            return True
+        except IntegrityError:
+            # il bucket c'era già (vuoto) o l'ha creato un'altra richiesta
+            return bool(conn.execute(aggiorna).rowcount)
+
+
+def azzera_limite_login(tipo: str, chiave: str) -> None:
+    """Dopo un login riuscito il bucket dell'account riparte pieno."""
+    tbl = LoginLimite.__table__
+    with engine.begin() as conn:
+        conn.execute(tbl.delete().where(tbl.c.chiave == f"{tipo}:{chiave}"))
+
+
+def pulisci_limiti_login() -> None:
+    """
+    Elimina (al massimo una volta al minuto per processo) i bucket rimasti
+    fermi più a lungo della finestra più ampia: sarebbero comunque pieni.
+    """
+    ora = time.time()
+    if ora - _pulizia_limiti['ultima'] < 60:
+        return
+    _pulizia_limiti['ultima'] = ora
+
+    finestra = max(f for _, f in LIMITI_LOGIN.values())
+    tbl = LoginLimite.__table__
+    try:
+        with engine.begin() as conn:
+            conn.execute(tbl.delete().where(tbl.c.aggiornato < ora - finestra))
+    except Exception as e:
+        print("Errore pulizia limiti login:", e)
+
+
+def registra_login_respinto(tipo: str) -> None:
+    """Log e metrica di un tentativo respinto dal limite `tipo`."""
+    print(f"Login respinto dal limite {tipo}: {request.remote_addr}")
+    LOGIN_RIFIUTATI.labels(limite=tipo).inc()
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'GET':
         return redirect(url_for('home'))
 
-    # piccolo rate limiting per tentativi falliti
-    failed_count = session.get("login_failed_count", 0)
-    last_failed_str = session.get("login_last_failed")
-    if last_failed_str:
-        try:
-            last_failed = datetime.fromisoformat(last_failed_str)
-            if datetime.utcnow() - last_failed < timedelta(minutes=10) and failed_count >= 5:
-                flash("Troppi tentativi falliti. Riprova tra qualche minuto.", "error")
-                return redirect(url_for('home'))
-        except Exception:
-            session.pop("login_failed_count", None)
-            session.pop("login_last_failed", None)
-
     email_or_username = (request.form.get('email_or_username') or '').strip()
     password = request.form.get('password') or ''
 
@@ -360,19 +2601,32 @@ def login():
         flash("Inserisci credenziali valide.", "error")
         return redirect(url_for('home'))
 
+    pulisci_limiti_login()
+
+    # limite per IP prima di qualunque lettura: copre anche chi prova
+    # molti account diversi dallo stesso indirizzo
+    if not consuma_gettone_login('ip', request.remote_addr or '-'):
+        registra_login_respinto('ip')
+        flash("Troppi tentativi di accesso. Riprova tra qualche minuto.", "error")
+        return redirect(url_for('home'))
+
     user = db_session.query(User).filter(
         (User.email == email_or_username.lower()) | (User.username == email_or_username)
     ).first()
 
+    # limite per account (per id: email e username condividono il bucket),
+    # sempre prima dell'hash della password
+    if user and not consuma_gettone_login('account', str(user.id)):
+        registra_login_respinto('account')
+        flash("Troppi tentativi falliti. Riprova tra qualche minuto.", "error")
+        return redirect(url_for('home'))
+
     if not user or not check_password_hash(user.password_hash, password):
-        session["login_failed_count"] = failed_count + 1
-        session["login_last_failed"] = datetime.utcnow().isoformat()
         flash("Credenziali non valide.", "error")
         return redirect(url_for('home'))
 
-    # login ok → reset rate limit
-    session.pop("login_failed_count", None)
-    session.pop("login_last_failed", None)
+    # login ok → il bucket dell'account riparte pieno
+    azzera_limite_login('account', str(user.id))
 
     # assicuro il wardrobe personale
     get_personal_wardrobe(user)
@@ -386,6 +2640,39 @@ def login():
     return redirect(url_for('private_wardrobe'))
 
 
+# dati dell'header per utente (nome, email, ultimo capo aggiunto)
+cache_header = CacheLRU(
+    'header',
+    dimensione=int(os.environ.get("HEADER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("HEADER_CACHE_TTL", "30"))
+)
+
+
+def formatta_ora_roma(raw_ts):
+    """Timestamp ISO (UTC se senza tz) come DD/MM/YYYY HH:MM in ora di Roma."""
+    if not raw_ts:
+        return None
+    try:
+        dt = datetime.fromisoformat(raw_ts)
+
+        # se nel DB è senza tz, assumiamo che sia UTC
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+
+        # converto in ora di Roma
+        if ZoneInfo is not None:
+            dt_local = dt.astimezone(ZoneInfo("Europe/Rome"))
+        else:
+            # fallback semplice: +1h (non perfetto ma meglio di niente)
+            dt_local = dt + timedelta(hours=1)
+
+        # formato DD/MM/YYYY HH:MM
+        return dt_local.strftime("%d/%m/%Y %H:%M")
+    except Exception:
+        # in caso di errore lascio la stringa grezza
+        return raw_ts
+
+
 @app.context_processor
 def inject_user_header_info():
     """
@@ -393,62 +2680,35 @@ def inject_user_header_info():
     - current_user_username
     - current_user_email
     - current_user_last_added (timestamp ultimo capo, formattato in ora di Roma)
+
+    Letti da cache_header; in caso di miss una sola query su users/wardrobes
+    (last_added_at è già denormalizzato sul wardrobe).
     """
     try:
         user_id = session.get('user_id')
         if not user_id:
             return {}
 
-        user = db_session.query(User).get(user_id)
-        if not user:
-            session.clear()
-            return {}
-
-        last_added = None
+        info = cache_header.get(user_id)
+        if info is None:
+            row = db_session.execute(
+                select(User.username, User.email, func.max(Wardrobe.last_added_at))
+                .outerjoin(Wardrobe, Wardrobe.user_id == User.id)
+                .where(User.id == user_id)
+                .group_by(User.id, User.username, User.email)
+            ).first()
+            if not row:
+                session.clear()
+                return {}
 
-        w = db_session.query(Wardrobe).filter_by(user_id=user_id).first()
-        if w:
-            metadata = MetaData()
-            inspector = inspect(engine)
-            existing_tables = set(inspector.get_table_names())
+            info = dict(
+                current_user_username=row[0],
+                current_user_email=row[1],
+                current_user_last_added=formatta_ora_roma(row[2])
+            )
+            cache_header.set(user_id, info)
 
-            if w.nome in existing_tables:
-                tbl = Table(w.nome, metadata, autoload_with=engine)
-                if 'created_at' in tbl.c:
-                    with engine.connect() as conn:
-                        row = conn.execute(
-                            tbl.select()
-                               .order_by(tbl.c.created_at.desc())
-                               .limit(1)
-                        ).first()
-                    if row:
-                        raw_ts = row._mapping.get('created_at')
-                        if raw_ts:
-                            try:
-                                dt = datetime.fromisoformat(raw_ts)
-
-                                # se nel DB è senza tz, assumiamo che sia UTC
-                                if dt.tzinfo is None:
-                                    dt = dt.replace(tzinfo=timezone.utc)
-
-                                # converto in ora di Roma
-                                if ZoneInfo is not None:
-                                    dt_local = dt.astimezone(ZoneInfo("Europe/Rome"))
-                                else:
-                                    # fallback semplice: +1h (non perfetto ma meglio di niente)
-                                    dt_local = dt + timedelta(hours=1)
-
-                                # formato DD/MM/YYYY HH:MM
-                                last_added = dt_local.strftime("%d/%m/%Y %H:%M")
-                            except Exception:
-                                # in caso di errore lascio la stringa grezza
-                                last_added = raw_ts
-
-        return dict(
-            current_user_username=user.username,
-            current_user_email=user.email,
-            current_user_last_added=last_added
-        )
+        return info
     except Exception:
         return {}
 
@@ -476,17 +2736,22 @@ def clear_wardrobe():
     Svuota TUTTI i capi del wardrobe personale dell'utente loggato.
     """
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(user_id=user_id).first()
+    w = next(iter(identita_corrente().wardrobes.values()), None)
     if not w:
         flash("Nessun wardrobe da svuotare.", "info")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
     try:
-        tbl = Table(w.nome, metadata, autoload_with=engine)
+        tbl, filtro = tabella_capi(w)
         with engine.begin() as conn:
-            conn.execute(tbl.delete())
+            rimuovi_dal_catalogo(conn, tbl, filtro)
+            conn.execute(tbl.delete().where(filtro))
+            aggiorna_ultimo_inserimento(conn, w)
+            controlla_prenotazioni(conn)
+        cache_header.invalida(user_id)
         flash("Wardrobe svuotato con successo.", "success")
+    except PrenotazioniScoperte as e:
+        flash(e.messaggio(), "error")
     except Exception as e:
         print("Errore clear_wardrobe:", e)
         flash("Errore durante la pulizia del wardrobe.", "error")
@@ -511,21 +2776,28 @@ def delete_account():
         # 1) Recupero tutti i wardrobe dell'utente
         wardrobes = db_session.query(Wardrobe).filter_by(user_id=user_id).all()
 
-        metadata = MetaData()
-        inspector = inspect(engine)
-        existing_tables = set(inspector.get_table_names())
-
-        # 2) Svuoto le tabelle fisiche dei wardrobe (NON le droppo)
-        for w in wardrobes:
-            if w.nome in existing_tables:
+        # 2) Svuoto i capi dei wardrobe (le tabelle fisiche NON le droppo)
+        if STORAGE_CONDIVISO:
+            if wardrobes:
+                tbl = Capo.__table__
+                filtro = tbl.c.wardrobe_id.in_([w.id for w in wardrobes])
+                with engine.begin() as conn:
+                    rimuovi_dal_catalogo(conn, tbl, filtro)
+                    conn.execute(tbl.delete().where(filtro))
+        else:
+            for w in wardrobes:
                 try:
-                    tbl = Table(w.nome, metadata, autoload_with=engine)
+                    tbl, filtro = tabella_capi(w)
                     with engine.begin() as conn:
-                        conn.execute(tbl.delete())
+                        rimuovi_dal_catalogo(conn, tbl, filtro)
+                        conn.execute(tbl.delete().where(filtro))
+                except NoSuchTableError:
+                    continue
                 except Exception as e:
                     print("Errore nello svuotare la tabella wardrobe:", w.nome, e)
 
-        # 3) Cancello le righe nella tabella master wardrobes
+        # 3) Cancello le prenotazioni dell'utente e le righe nella tabella master wardrobes
+        db_session.query(Prenotazione).filter_by(user_id=user_id).delete(synchronize_session=False)
         db_session.query(Wardrobe).filter_by(user_id=user_id).delete(synchronize_session=False)
 
         # 4) Cancello l'utente
@@ -540,62 +2812,689 @@ def delete_account():
         flash("Si è verificato un errore durante l'eliminazione dell'account.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    # 6) Pulisco la sessione e porto alla home
-    session.clear()
-    flash("Account e dati associati eliminati definitivamente.", "success")
-    return redirect(url_for('home'))
+    # 6) Pulisco la sessione e le cache dell'utente e porto alla home
+    cache_header.invalida(user_id)
+    invalida_identita(user_id)
+    session.clear()
+    flash("Account e dati associati eliminati definitivamente.", "success")
+    return redirect(url_for('home'))
+
+
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('home'))
+
+
+# ----------------------------
+#       ROUTE PUBBLICHE
+# ----------------------------
+
+# firma di template e codice: con un deploy nuovo cambiano gli ETag di
+# tutte le pagine. Dal contenuto dei file (non dagli mtime, diversi tra
+# macchine e deploy dello stesso codice) o da RELEASE_ID se impostato, così
+# è uguale in tutti i worker e in tutte le istanze dietro il balancer
+def _firma_pagine() -> str:
+    rilascio = os.environ.get("RELEASE_ID") or os.environ.get("RENDER_GIT_COMMIT")
+    if rilascio:
+        return hashlib.sha1(rilascio.encode()).hexdigest()[:12]
+    h = hashlib.sha1()
+    cartella = os.path.join(app.root_path, app.template_folder)
+    file = []
+    for radice, _, nomi in os.walk(cartella):
+        file += [os.path.join(radice, n) for n in nomi]
+    for percorso in sorted(file) + [os.path.abspath(__file__)]:
+        h.update(os.path.relpath(percorso, app.root_path).encode() + b'\0')
+        with open(percorso, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()[:12]
+
+
+FIRMA_PAGINE = _firma_pagine()
+
+
+def etag_pagina(*versioni):
+    """
+    ETag debole di una pagina HTML: versioni dei dati mostrati, utente e
+    firma dei template. Ritorna (etag, risposta 304 se il client ha già
+    questa versione, altrimenti None). Con messaggi flash in attesa niente
+    ETag: la pagina li mostra una volta sola.
+    """
+    if session.get('_flashes'):
+        return None, None
+    parti = (FIRMA_PAGINE, session.get('user_id') or 0) + versioni
+    etag = hashlib.sha1(repr(parti).encode()).hexdigest()[:20]
+    if request.if_none_match.contains_weak(etag):
+        return etag, con_etag(Response(status=304), etag)
+    return etag, None
+
+
+def con_etag(risposta, etag):
+    """Aggiunge ETag (se c'è) e Cache-Control privato da rivalidare a ogni visita."""
+    resp = make_response(risposta)
+    if etag:
+        resp.set_etag(etag, weak=True)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def versione_wardrobe(w) -> int | None:
+    """
+    wardrobes.versione corrente (una query sulla chiave primaria, una volta
+    per richiesta); None se il wardrobe non esiste più.
+    """
+    versioni = g.setdefault('versioni_wardrobe', {})
+    if w.id not in versioni:
+        tbl = Wardrobe.__table__
+        with engine.connect() as conn:
+            versioni[w.id] = conn.execute(select(tbl.c.versione).where(tbl.c.id == w.id)).scalar()
+    return versioni[w.id]
+
+
+def versione_indice() -> tuple[int, int]:
+    """(versione, ricostruzione) del catalogo come la vede indice_facette."""
+    indice_facette.sincronizza()
+    return indice_facette.versione, indice_facette.ricostruzione
+
+
+# HTML già renderizzato dei blocchi della home uguali per tutti (featured,
+# filtri, griglia prodotti), per (nome, versione del catalogo): una scrittura
+# sul catalogo cambia la chiave, il TTL fa solo uscire le versioni vecchie
+cache_frammenti = CacheLRU(
+    'frammenti',
+    dimensione=int(os.environ.get("FRAGMENT_CACHE_SIZE", "64")),
+    ttl=float(os.environ.get("FRAGMENT_CACHE_TTL", "3600"))
+)
+
+
+def frammenti_catalogo(frammenti: dict, carica) -> dict:
+    """
+    HTML dei frammenti {nome: template}, dalla cache o renderizzati con il
+    contesto ritornato da `carica()`, chiamata solo se ne manca almeno uno.
+    La versione è quella già sincronizzata da indice_facette (nessuna query
+    in più tra una sincronizzazione e l'altra).
+    """
+    versione = versione_indice()
+
+    html = {}
+    contesto = None
+    for nome, template in frammenti.items():
+        chiave = (nome, versione)
+        frammento = cache_frammenti.get(chiave)
+        if frammento is None:
+            if contesto is None:
+                contesto = carica()
+            frammento = Markup(render_template(template, **contesto))
+            cache_frammenti.set(chiave, frammento)
+        html[nome] = frammento
+    return html
+
+
+def _contesto_home() -> dict:
+    # solo la prima pagina del catalogo (i più recenti primi):
+    # il resto lo carica lo scroll infinito da /api/catalog
+    capi, next_cursor = cerca_catalogo({})
+    return dict(
+        # prendo max 8 capi come "featured"
+        featured_capi=capi[:8],
+        capi=capi,
+        next_cursor=next_cursor,
+        totale_capi=indice_facette.conta({}),
+        filtri=indice_facette.conteggi({}, FILTRI_CATALOGO)
+    )
+
+
+@app.route('/')
+def home():
+    etag, non_modificata = etag_pagina('home', versione_indice())
+    if non_modificata:
+        return non_modificata
+
+    frammenti = frammenti_catalogo({
+        'featured': 'index_featured.html',
+        'filtri': 'index_filtri.html',
+        'prodotti': 'index_prodotti.html',
+    }, _contesto_home)
+    return con_etag(render_template('index.html', frammenti=frammenti), etag)
+
+
+def _voce_json(capo: dict) -> dict:
+    """Voce del catalogo per le API JSON, con URL e srcset delle immagini."""
+    item = {k: capo[k] for k in ('id', 'disponibilita', 'created_at') + CHIAVE_CATALOGO}
+    for campo in ('immagine', 'immagine2'):
+        if capo[campo]:
+            item[f'url_{campo}'] = url_immagine(capo[campo], 640)
+            item[f'srcset_{campo}'] = srcset_immagine(capo[campo])
+    return item
+
+
+def _parametri_ricerca():
+    q = request.args.get('q', '').strip()[:200]
+    filtri = {k: request.args.get(k, '').strip() for k in FILTRI_CATALOGO}
+    limite = request.args.get('limit', PAGINA_CATALOGO, type=int)
+    limite = max(1, min(limite, MAX_RISULTATI_RICERCA))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return q, filtri, limite, offset
+
+
+@app.route('/api/catalog')
+def api_catalog():
+    """
+    Catalogo pubblico in JSON, a pagine.
+    Parametri: categoria, taglia, brand, destinazione, colore (filtri),
+    ordine=recenti|meno_recenti, limit (max MAX_PAGINA_CATALOGO), cursor.
+    """
+    filtri = {k: request.args.get(k, '').strip() for k in FILTRI_CATALOGO}
+    crescente = request.args.get('ordine', 'recenti') == 'meno_recenti'
+    limite = request.args.get('limit', PAGINA_CATALOGO, type=int)
+    limite = max(1, min(limite, MAX_PAGINA_CATALOGO))
+    cursore = request.args.get('cursor') or None
+
+    try:
+        capi, next_cursor = cerca_catalogo(filtri, limite, cursore, crescente)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    payload = {'items': [_voce_json(c) for c in capi], 'next_cursor': next_cursor}
+    if not cursore:
+        payload['totale'] = conta_catalogo(filtri)
+    return jsonify(payload)
+
+
+@app.route('/api/catalog/facets')
+def api_catalog_facets():
+    """
+    Conteggi per valore di ogni facetta del catalogo, dati i filtri correnti
+    (stessi parametri di /api/catalog; un parametro ripetuto vale come OR).
+    """
+    filtri = {
+        f: [v for v in request.args.getlist(f) if v]
+        for f in FACETTE_CATALOGO
+    }
+    filtri = {f: v for f, v in filtri.items() if v}
+
+    return jsonify(
+        totale=indice_facette.conta(filtri),
+        facette=indice_facette.conteggi(filtri),
+        versione=indice_facette.versione
+    )
+
+
+@app.route('/api/search')
+def api_search():
+    """
+    Ricerca full-text nel catalogo pubblico, per rilevanza.
+    Parametri: q, filtri di /api/catalog, limit (max MAX_RISULTATI_RICERCA), offset.
+    """
+    q, filtri, limite, offset = _parametri_ricerca()
+    capi, altri = cerca_testo(q, filtri, limite, offset)
+    return jsonify(
+        q=q,
+        items=[_voce_json(c) for c in capi],
+        next_offset=offset + limite if altri else None
+    )
+
+
+@app.route('/search')
+def search():
+    q, filtri, limite, offset = _parametri_ricerca()
+    capi, altri = cerca_testo(q, filtri, limite, offset)
+    # filtri attivi (e limit esplicito) da ripassare ai link delle pagine
+    parametri = {k: v for k, v in filtri.items() if v}
+    if 'limit' in request.args:
+        parametri['limit'] = limite
+    return render_template(
+        'search.html',
+        q=q,
+        capi=capi,
+        offset=offset,
+        limite=limite,
+        altri=altri,
+        parametri=parametri
+    )
+
+
+@app.route('/api/taxonomy')
+def api_taxonomy():
+    """
+    Opzioni dei form (form_data.json) con la loro versione. Con ?v=<versione>
+    corrente la risposta è immutabile; senza, va rivalidata con l'ETag.
+    """
+    tassonomia.get()
+    etag = tassonomia.versione
+    if request.args.get('v') == etag:
+        cache = f'public, max-age={CACHE_IMMUTABILE}, immutable'
+    else:
+        cache = 'public, no-cache'
+
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(tassonomia.json, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache
+    return resp
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Metriche Prometheus: del processo, o di tutti i worker se è impostata
+    PROMETHEUS_MULTIPROC_DIR. Se METRICS_TOKEN è impostato serve l'header
+    'Authorization: Bearer <token>'.
+    """
+    if prometheus_client is None:
+        return Response("prometheus_client non installato\n", status=404, mimetype='text/plain')
+
+    token = os.environ.get("METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response(status=401)
+
+    if METRICHE_MULTIPROCESSO:
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    return Response(
+        prometheus_client.generate_latest(registry),
+        mimetype=prometheus_client.CONTENT_TYPE_LATEST
+    )
+
+
+@app.route('/products')
+@app.route('/public-wardrobe')
+def products():
+    # Ora la sezione Products � integrata nella home; reindirizziamo all'anchor
+    return redirect(url_for('home') + "#products")
+
+
+
+@app.route('/about')
+def about():
+    return render_template('about.html')
+
+
+@app.route('/immagini/<path:filename>')
+def immagini(filename):
+    """
+    Serve un'immagine caricata. Con ?w=<px> serve il derivato della larghezza
+    più adatta, in WebP se il browser lo accetta (o con ?fmt=webp|jpg).
+    Senza derivati serve l'originale: senza cache se la coda li sta
+    generando (appena pronti il browser deve vederli), altrimenti (immagini
+    del sito, upload precedenti ai derivati) con la cache di un originale
+    non immutabile, finché `flask genera-derivati` non li crea.
+    """
+    larghezza = request.args.get('w', type=int)
+    if larghezza:
+        formato = request.args.get('fmt')
+        negoziato = formato not in ('webp', 'jpg')
+        if negoziato:
+            formato = 'webp' if request.accept_mimetypes['image/webp'] else 'jpg'
+
+        variante = scegli_derivato(filename, larghezza, formato)
+        if variante:
+            CACHE_ACCESSI.labels(cache='derivati', esito='hit').inc()
+            response = _invia_immagine(
+                os.path.join(app.config['UPLOAD_FOLDER'], CARTELLA_DERIVATI), variante
+            )
+            if negoziato:
+                response.vary.add('Accept')
+            return _conta_byte_immagine(response, 'derivato')
+        CACHE_ACCESSI.labels(cache='derivati', esito='miss').inc()
+        return _conta_byte_immagine(
+            _invia_immagine(app.config['UPLOAD_FOLDER'], filename,
+                            provvisoria=in_lavorazione(filename), sostituibile=True),
+            'originale'
+        )
+
+    return _conta_byte_immagine(_invia_immagine(app.config['UPLOAD_FOLDER'], filename), 'originale')
+
+
+def _conta_byte_immagine(response, tipo: str):
+    # i 304 non trasferiscono il file
+    if response.status_code in (200, 206) and response.content_length:
+        IMMAGINI_BYTE.labels(tipo=tipo).inc(response.content_length)
+    return response
+
+
+def _invia_immagine(cartella: str, nome: str, provvisoria: bool = False,
+                    sostituibile: bool = False):
+    """
+    send_from_directory con le intestazioni di cache giuste: i file indirizzati
+    per contenuto sono immutabili (ETag = nome del file, quindi 304 senza
+    rileggere il file); gli altri possono essere sovrascritti e vanno
+    rivalidati. `provvisoria`: l'originale servito al posto di un derivato
+    non ancora pronto, da non mettere in cache. `sostituibile`: l'originale
+    servito al posto di un derivato che potrà esistere in futuro (mai immutabile).
+    """
+    if provvisoria:
+        response = send_from_directory(cartella, nome, max_age=0)
+        response.cache_control.no_cache = True
+        return response
+
+    if not sostituibile and NOME_PER_CONTENUTO.match(os.path.basename(nome)):
+        response = send_from_directory(
+            cartella, nome, etag=os.path.basename(nome), max_age=CACHE_IMMUTABILE
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    response = send_from_directory(cartella, nome, max_age=CACHE_IMMAGINI_LEGACY)
+    response.cache_control.public = True
+    return response
+
+
+@app.route('/contact')
+def contact():
+    return render_template('contact.html')
+
+
+# ----------------------------
+#       NOLEGGI (PRENOTAZIONI)
+# ----------------------------
+
+# pezzi liberi di una voce tra D1 e D2 = disponibilita - massimo dei pezzi
+# prenotati nello stesso giorno dentro [D1, D2]: le prenotazioni si leggono
+# dall'indice (chiave, fine, inizio), solo quelle della voce che si
+# sovrappongono all'intervallo.
+MAX_GIORNI_NOLEGGIO = int(os.environ.get("MAX_GIORNI_NOLEGGIO", "60"))
+MAX_VOCI_DISPONIBILITA = 100
+
+
+def _date_noleggio(dal: str, al: str) -> tuple[str, str]:
+    """Valida l'intervallo (date ISO, al >= dal, non nel passato); ValueError se no."""
+    try:
+        inizio, fine = date.fromisoformat(dal or ''), date.fromisoformat(al or '')
+    except (ValueError, TypeError):
+        raise ValueError("date non valide (formato YYYY-MM-DD)")
+    if fine < inizio:
+        raise ValueError("la data di fine precede quella di inizio")
+    if inizio < date.today():
+        raise ValueError("la data di inizio è nel passato")
+    if (fine - inizio).days + 1 > MAX_GIORNI_NOLEGGIO:
+        raise ValueError(f"noleggio massimo di {MAX_GIORNI_NOLEGGIO} giorni")
+    return inizio.isoformat(), fine.isoformat()
+
+
+def picco_prenotati(intervalli, dal: str, al: str) -> int:
+    """
+    Massimo di pezzi prenotati contemporaneamente in un giorno di [dal, al],
+    da (inizio, fine, quantita) già filtrati per sovrapposizione (sweep line).
+    """
+    eventi = []
+    for inizio, fine, quantita in intervalli:
+        eventi.append((max(inizio, dal), quantita))
+        # fine esclusa: il giorno dopo la fine (o dopo `al`) il pezzo torna libero
+        uscita = date.fromisoformat(min(fine, al)) + timedelta(days=1)
+        eventi.append((uscita.isoformat(), -quantita))
+    # a parità di giorno prima i rientri, poi le uscite
+    eventi.sort(key=lambda e: (e[0], e[1]))
+    picco = attuali = 0
+    for _, delta in eventi:
+        attuali += delta
+        picco = max(picco, attuali)
+    return picco
+
+
+def _prenotazioni_sovrapposte(conn, chiavi: list[str], dal: str, al: str) -> dict:
+    """chiave -> [(inizio, fine, quantita)] delle prenotazioni attive che toccano [dal, al]."""
+    pren = Prenotazione.__table__
+    righe = conn.execute(
+        select(pren.c.chiave, pren.c.inizio, pren.c.fine, pren.c.quantita)
+        .where(pren.c.chiave.in_(chiavi), pren.c.fine >= dal,
+               pren.c.inizio <= al, pren.c.stato == 'attiva')
+    )
+    per_chiave = {}
+    for r in righe:
+        per_chiave.setdefault(r.chiave, []).append((r.inizio, r.fine, r.quantita))
+    return per_chiave
+
 
+def disponibilita_noleggio(voce_ids: list[int], dal: str, al: str) -> dict:
+    """Pezzi liberi tra `dal` e `al` per ogni voce del catalogo (due query in tutto)."""
+    tbl = CatalogoCapo.__table__
+    with engine.connect() as conn:
+        voci = conn.execute(
+            select(tbl.c.id, tbl.c.chiave, tbl.c.disponibilita).where(tbl.c.id.in_(voce_ids))
+        ).fetchall()
+        prenotate = _prenotazioni_sovrapposte(conn, [v.chiave for v in voci], dal, al) if voci else {}
+    return {
+        v.id: max(0, v.disponibilita - picco_prenotati(prenotate.get(v.chiave, ()), dal, al))
+        for v in voci
+    }
 
 
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('home'))
+class PrenotazioneNonDisponibile(Exception):
+    """Pezzi insufficienti per almeno una voce: `liberi` = {voce_id: pezzi liberi}."""
 
+    def __init__(self, liberi: dict):
+        super().__init__("pezzi non disponibili")
+        self.liberi = liberi
 
-# ----------------------------
-#       ROUTE PUBBLICHE
-# ----------------------------
 
-@app.route('/')
-def home():
-    capi_aggregati = get_aggregated_capi()
+def prenota(user_id: int, righe: dict, dal: str, al: str) -> list[int]:
+    """
+    Prenota tutte le righe ({voce_id: quantita}) o nessuna. Ogni voce viene
+    bloccata (UPDATE a vuoto sulla riga del catalogo: lock di riga su
+    Postgres, lock di scrittura su SQLite) prima di contare i pezzi liberi,
+    così due checkout concorrenti non possono vendere lo stesso pezzo.
+    Ritorna gli id delle prenotazioni; PrenotazioneNonDisponibile se mancano pezzi.
+    """
+    tbl = CatalogoCapo.__table__
+    pren = Prenotazione.__table__
+    creato = datetime.now(timezone.utc).isoformat()
+    ids = []
+    with engine.begin() as conn:
+        voci = {}
+        # sempre nello stesso ordine: niente deadlock tra carrelli con le stesse voci
+        for voce_id in sorted(righe):
+            bloccata = conn.execute(
+                tbl.update().where(tbl.c.id == voce_id)
+                   .values(disponibilita=tbl.c.disponibilita)
+                   .returning(tbl.c.chiave, tbl.c.disponibilita)
+            ).first()
+            if bloccata is not None:
+                voci[voce_id] = bloccata
+
+        prenotate = _prenotazioni_sovrapposte(conn, [v.chiave for v in voci.values()], dal, al)
+        liberi = {
+            voce_id: max(0, v.disponibilita - picco_prenotati(prenotate.get(v.chiave, ()), dal, al))
+            for voce_id, v in voci.items()
+        }
+        mancanti = {
+            voce_id: liberi.get(voce_id, 0)
+            for voce_id, quantita in righe.items()
+            if quantita > liberi.get(voce_id, 0)
+        }
+        if mancanti:
+            raise PrenotazioneNonDisponibile(mancanti)
 
-    # ordino per created_at (i più recenti primi, se presente)
-    sorted_capi = sorted(
-        capi_aggregati,
-        key=lambda x: x.get('created_at') or '',
-        reverse=True
-    )
+        for voce_id in sorted(righe):
+            ids.append(conn.execute(pren.insert().values(
+                chiave=voci[voce_id].chiave,
+                user_id=user_id,
+                quantita=righe[voce_id],
+                inizio=dal,
+                fine=al,
+                stato='attiva',
+                created_at=creato
+            )).inserted_primary_key[0])
+    return ids
 
-    # prendo max 8 capi come "featured"
-    featured_capi = sorted_capi[:8]
 
-    return render_template('index.html', featured_capi=featured_capi, capi=capi_aggregati)
+class PrenotazioniScoperte(Exception):
+    """Pezzi scesi sotto quelli già noleggiati: `voci` = {chiave: (pezzi, picco prenotati)}."""
 
+    def __init__(self, voci: dict):
+        super().__init__("pezzi già prenotati")
+        self.voci = voci
 
+    def messaggio(self) -> str:
+        pezzi, picco = max(self.voci.values(), key=lambda v: v[1] - v[0])
+        return (f"Operazione annullata: {picco} pezzi sono già prenotati nelle "
+                f"prossime date e ne resterebbero {pezzi}.")
 
-@app.route('/products')
-@app.route('/public-wardrobe')
-def products():
-    # Ora la sezione Products � integrata nella home; reindirizziamo all'anchor
-    return redirect(url_for('home') + "#products")
 
+# fine "aperta" per contare tutte le prenotazioni future con picco_prenotati
+FINE_PRENOTAZIONI = '9999-12-30'
 
 
-@app.route('/about')
-def about():
-    return render_template('about.html')
+def _prenotazioni_future(conn, chiavi: list[str]) -> dict:
+    """
+    chiave -> (pezzi della voce, prenotazioni attive non ancora finite in
+    ordine di id), due query per blocco di chiavi.
+    """
+    tbl = CatalogoCapo.__table__
+    pren = Prenotazione.__table__
+    risultato = {}
+    for i in range(0, len(chiavi), 500):
+        blocco = chiavi[i:i + 500]
+        pezzi = dict(conn.execute(
+            select(tbl.c.chiave, tbl.c.disponibilita).where(tbl.c.chiave.in_(blocco))
+        ).all())
+        righe = {}
+        for r in conn.execute(
+            select(pren.c.chiave, pren.c.id, pren.c.inizio, pren.c.fine, pren.c.quantita)
+            .where(pren.c.chiave.in_(blocco), pren.c.stato == 'attiva',
+                   pren.c.fine >= date.today().isoformat())
+            .order_by(pren.c.id)
+        ):
+            righe.setdefault(r.chiave, []).append(r)
+        for chiave in blocco:
+            risultato[chiave] = (pezzi.get(chiave) or 0, righe.get(chiave, []))
+    return risultato
+
+
+def _picco_futuro(righe) -> int:
+    return picco_prenotati([(r.inizio, r.fine, r.quantita) for r in righe],
+                           date.today().isoformat(), FINE_PRENOTAZIONI)
+
+
+def sposta_prenotazioni(conn, vecchia: str, nuova: str) -> int:
+    """
+    Un capo modificato porta i suoi pezzi dalla voce `vecchia` a `nuova`:
+    le prenotazioni attive che la vecchia voce non copre più passano alla
+    nuova, dalle più recenti. Va chiamata dopo aggiorna_catalogo (le due
+    voci sono già bloccate). Ritorna quante prenotazioni ha spostato.
+    """
+    pezzi, righe = _prenotazioni_future(conn, [vecchia])[vecchia]
+    spostate = []
+    while righe and _picco_futuro(righe) > pezzi:
+        spostate.append(righe.pop().id)
+    if spostate:
+        pren = Prenotazione.__table__
+        conn.execute(pren.update().where(pren.c.id.in_(spostate)).values(chiave=nuova))
+        # la nuova voce ora deve coprire anche queste
+        conn.info.setdefault('voci_scalate', set()).add(nuova)
+    return len(spostate)
+
+
+def controlla_prenotazioni(conn) -> None:
+    """
+    Prima del commit di una route che ha tolto pezzi: PrenotazioniScoperte
+    se una voce scalata ha meno pezzi del picco già prenotato (la
+    transazione va annullata, come per un checkout senza pezzi).
+    """
+    scoperte = {}
+    chiavi = sorted(conn.info.pop('voci_scalate', ()))
+    for chiave, (pezzi, righe) in _prenotazioni_future(conn, chiavi).items():
+        picco = _picco_futuro(righe)
+        if picco > pezzi:
+            scoperte[chiave] = (pezzi, picco)
+    if scoperte:
+        raise PrenotazioniScoperte(scoperte)
+
+
+@app.route('/api/disponibilita')
+def api_disponibilita():
+    """
+    Pezzi liberi a noleggio per più voci del catalogo (es. una pagina).
+    Parametri: ids=1,2,3 (max MAX_VOCI_DISPONIBILITA), dal, al (YYYY-MM-DD).
+    """
+    try:
+        dal, al = _date_noleggio(request.args.get('dal'), request.args.get('al'))
+        voce_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if not voce_ids or len(voce_ids) > MAX_VOCI_DISPONIBILITA:
+        return jsonify(error=f"da 1 a {MAX_VOCI_DISPONIBILITA} ids"), 400
 
+    liberi = disponibilita_noleggio(voce_ids, dal, al)
+    return jsonify(dal=dal, al=al, disponibilita={str(k): v for k, v in liberi.items()})
 
-@app.route('/immagini/<path:filename>')
-def immagini(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/api/prenotazioni', methods=['GET', 'POST'])
+def api_prenotazioni():
+    """
+    GET: prenotazioni attive dell'utente. POST (JSON): {"dal", "al",
+    "items": [{"id": voce_id, "qty": n}, ...]} prenota tutto o niente;
+    409 con i pezzi liberi se qualcosa non basta.
+    """
+    ident = identita_corrente() if session.get('user_id') else None
+    if ident is None:
+        return jsonify(error="login richiesto"), 401
 
-@app.route('/contact')
-def contact():
-    return render_template('contact.html')
+    pren = Prenotazione.__table__
+    if request.method == 'GET':
+        tbl = CatalogoCapo.__table__
+        with engine.connect() as conn:
+            righe = conn.execute(
+                select(pren.c.id, pren.c.quantita, pren.c.inizio, pren.c.fine,
+                       tbl.c.id.label('voce_id'), tbl.c.tipologia, tbl.c.brand, tbl.c.colore, tbl.c.taglia)
+                .select_from(pren.outerjoin(tbl, tbl.c.chiave == pren.c.chiave))
+                .where(pren.c.user_id == ident.id, pren.c.stato == 'attiva',
+                       pren.c.fine >= date.today().isoformat())
+                .order_by(pren.c.inizio, pren.c.id)
+            ).fetchall()
+        return jsonify(items=[dict(r._mapping) for r in righe])
+
+    dati = request.get_json(silent=True)
+    if not isinstance(dati, dict) or not isinstance(dati.get('items'), list):
+        return jsonify(error="richiesta non valida"), 400
+    try:
+        dal, al = _date_noleggio(dati.get('dal'), dati.get('al'))
+        righe = {}
+        for item in dati['items']:
+            try:
+                voce_id, quantita = int(item['id']), int(item.get('qty', 1))
+            except (ValueError, TypeError, KeyError):
+                raise ValueError("voce del carrello non valida")
+            if quantita < 1:
+                raise ValueError("quantità non valida")
+            righe[voce_id] = righe.get(voce_id, 0) + quantita
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if not righe or len(righe) > MAX_VOCI_DISPONIBILITA:
+        return jsonify(error="carrello vuoto o troppo grande"), 400
+
+    try:
+        ids = prenota(ident.id, righe, dal, al)
+    except PrenotazioneNonDisponibile as e:
+        return jsonify(error="pezzi non disponibili",
+                       disponibilita={str(k): v for k, v in e.liberi.items()}), 409
+    return jsonify(dal=dal, al=al, prenotazioni=ids), 201
+
+
+@app.route('/api/prenotazioni/<int:prenotazione_id>', methods=['DELETE'])
+def api_annulla_prenotazione(prenotazione_id):
+    """Annulla una prenotazione dell'utente (i pezzi tornano liberi)."""
+    if not session.get('user_id') or identita_corrente() is None:
+        return jsonify(error="login richiesto"), 401
+
+    pren = Prenotazione.__table__
+    with engine.begin() as conn:
+        n = conn.execute(
+            pren.update()
+                .where(pren.c.id == prenotazione_id, pren.c.user_id == session['user_id'],
+                       pren.c.stato == 'attiva')
+                .values(stato='annullata')
+        ).rowcount
+    if not n:
+        return jsonify(error="prenotazione non trovata"), 404
+    return jsonify(ok=True)
 
 
 # ----------------------------
@@ -611,33 +3510,45 @@ def private_wardrobe():
         flash("Sessione non valida. Effettua di nuovo il login.", "error")
         return redirect(url_for('home'))
 
-    user = db_session.query(User).get(user_id)
+    user = identita_corrente()
     if not user:
         session.clear()
         flash("Utente non trovato. Effettua di nuovo il login.", "error")
         return redirect(url_for('home'))
 
     w = get_personal_wardrobe(user)
+    if versione_wardrobe(w) is None:
+        # eliminato da un altro worker: rileggo l'identità e riprovo
+        invalida_identita(user_id)
+        return redirect(url_for('private_wardrobe'))
+
+    etag, non_modificata = etag_pagina(
+        'private_wardrobe', w.id, versione_wardrobe(w), sorted(immagini_in_lavorazione())
+    )
+    if non_modificata:
+        return non_modificata
 
-    metadata = MetaData()
     capi = []
 
     try:
-        wardrobe_table = Table(w.nome, metadata, autoload_with=engine)
+        wardrobe_table, filtro = tabella_capi(w)
         with engine.connect() as conn:
-            rows = conn.execute(wardrobe_table.select()).fetchall()
+            rows = conn.execute(
+                wardrobe_table.select().where(filtro).order_by(wardrobe_table.c.id)
+            ).fetchall()
             columns = wardrobe_table.columns.keys()
             capi = [dict(zip(columns, row)) for row in rows]
     except Exception as e:
         print("Errore private_wardrobe:", e)
         flash("Si è verificato un problema nel caricamento del guardaroba.", "error")
+        etag = None
 
-    return render_template(
+    return con_etag(render_template(
         'private_wardrobe.html',
         capi=capi,
         nome_tabella=w.nome,
         username=user.username
-    )
+    ), etag)
 
 
 @app.route('/create-private-wardrobe', methods=['GET', 'POST'])
@@ -654,8 +3565,7 @@ def select_private_wardrobe():
     Per ora abbiamo 1 wardrobe personale. Se in futuro vuoi più wardrobe,
     qui puoi caricare la lista.
     """
-    user_id = session['user_id']
-    wardrobes = db_session.query(Wardrobe).filter_by(user_id=user_id).all()
+    wardrobes = list(identita_corrente().wardrobes.values())
     return render_template('select_private_wardrobe.html', wardrobes=wardrobes)
 
 
@@ -663,15 +3573,16 @@ def select_private_wardrobe():
 @login_required
 def gestisci_private_wardrobe(nome_tabella):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
-    wardrobe_table = Table(nome_tabella, metadata, autoload_with=engine)
+    wardrobe_table, filtro = tabella_capi(w)
     with engine.connect() as conn:
-        rows = conn.execute(wardrobe_table.select()).fetchall()
+        rows = conn.execute(
+            wardrobe_table.select().where(filtro).order_by(wardrobe_table.c.id)
+        ).fetchall()
         columns = wardrobe_table.columns.keys()
         capi = [dict(zip(columns, row)) for row in rows]
     return render_template('gestisci_private_wardrobe.html', capi=capi, nome_tabella=nome_tabella)
@@ -681,13 +3592,12 @@ def gestisci_private_wardrobe(nome_tabella):
 @login_required
 def aggiungi_capo_wardrobe(nome_tabella):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    with open('static/data/form_data.json') as f:
-        data = json.load(f)
+    data = tassonomia.get()
 
     if request.method == 'POST':
         try:
@@ -709,35 +3619,33 @@ def aggiungi_capo_wardrobe(nome_tabella):
                 flash("Tutti i campi e l'immagine principale sono obbligatori.", "error")
                 return redirect(url_for('aggiungi_capo_wardrobe', nome_tabella=nome_tabella))
 
+            errori = tassonomia.errori(values_base)
+            if errori:
+                flash(f"Valori non validi per: {', '.join(errori)}.", "error")
+                return redirect(url_for('aggiungi_capo_wardrobe', nome_tabella=nome_tabella))
+
             if not allowed_file(file.filename):
                 flash("Formato immagine non valido.", "error")
                 return redirect(url_for('aggiungi_capo_wardrobe', nome_tabella=nome_tabella))
 
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
             # salvo l'immagine principale UNA volta
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            values_base['immagine'] = filename
+            values_base['immagine'] = salva_upload(file)
 
             # immagine retro (se presente) — sempre la stessa per tutti i capi uguali
             if file2 and allowed_file(file2.filename):
-                filename2 = secure_filename(file2.filename)
-                file2.save(os.path.join(app.config['UPLOAD_FOLDER'], filename2))
-                values_base['immagine2'] = filename2
+                values_base['immagine2'] = salva_upload(file2)
             else:
                 values_base['immagine2'] = None
 
-            metadata = MetaData()
-            tbl = Table(nome_tabella, metadata, autoload_with=engine)
+            tbl, _ = tabella_capi(w)
+            if 'created_at' in tbl.c:
+                values_base['created_at'] = datetime.now(timezone.utc).isoformat()
 
+            # una sola riga con la quantita (incrementata se il capo c'è già)
             with engine.begin() as conn:
-                for _ in range(quantita):
-                    values = dict(values_base)
-                    # created_at per ogni capo
-                    if 'created_at' in tbl.c:
-                        values['created_at'] = datetime.now(timezone.utc).isoformat()
-                    conn.execute(tbl.insert().values(**values))
+                aggiungi_pezzi(conn, w, values_base, quantita)
+                aggiorna_ultimo_inserimento(conn, w)
+            cache_header.invalida(user_id)
 
             flash(f"{quantita} capo/capi aggiunti correttamente.", "success")
             return redirect(url_for('private_wardrobe'))
@@ -754,25 +3662,21 @@ def aggiungi_capo_wardrobe(nome_tabella):
 @login_required
 def modifica_capo_wardrobe(nome_tabella, capo_id):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
-    wardrobe_table = Table(nome_tabella, metadata, autoload_with=engine)
+    wardrobe_table, filtro = tabella_capi(w)
 
-    try:
-        with open(os.path.join(BASE_DIR, 'static', 'data', 'form_data.json'), encoding='utf-8') as f:
-            data = json.load(f)
-    except Exception as e:
-        print("Errore lettura form_data.json:", e)
+    data = tassonomia.get()
+    if not data:
         flash("Errore interno: file di configurazione form non trovato.", "error")
         return redirect(url_for('private_wardrobe'))
 
     with engine.connect() as conn:
         capo = conn.execute(
-            wardrobe_table.select().where(wardrobe_table.c.id == capo_id)
+            wardrobe_table.select().where(filtro, wardrobe_table.c.id == capo_id)
         ).first()
 
     if not capo:
@@ -787,35 +3691,74 @@ def modifica_capo_wardrobe(nome_tabella, capo_id):
                 field: request.form[field]
                 for field in ['categoria', 'tipologia', 'taglia', 'fit', 'colore', 'brand', 'destinazione']
             }
+            errori = tassonomia.errori(values, capo_dict)
+            if errori:
+                flash(f"Valori non validi per: {', '.join(errori)}.", "error")
+                return redirect(url_for('modifica_capo_wardrobe', nome_tabella=nome_tabella, capo_id=capo_id))
+
+            try:
+                quantita = max(1, int(request.form.get('quantita', capo_dict['quantita'])))
+            except ValueError:
+                quantita = capo_dict['quantita']
+
             file = request.files.get('immagine')
             file2 = request.files.get('immagine2')
 
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                values['immagine'] = filename
+                values['immagine'] = salva_upload(file)
             else:
                 values['immagine'] = capo_dict.get('immagine')
 
             if file2 and allowed_file(file2.filename):
-                filename2 = secure_filename(file2.filename)
-                file2.save(os.path.join(app.config['UPLOAD_FOLDER'], filename2))
-                values['immagine2'] = filename2
+                values['immagine2'] = salva_upload(file2)
             else:
                 values['immagine2'] = capo_dict.get('immagine2')
 
             with engine.begin() as conn:
-                conn.execute(
-                    wardrobe_table.update()
-                    .where(wardrobe_table.c.id == capo_id)
-                    .values(**values)
-                )
+                nuovo = {**capo_dict, **values}
+                if chiave_catalogo(nuovo) == chiave_catalogo(capo_dict):
+                    conn.execute(
+                        wardrobe_table.update()
+                        .where(filtro, wardrobe_table.c.id == capo_id)
+                        .values(quantita=quantita)
+                    )
+                    aggiorna_catalogo(conn, capo_dict, quantita - capo_dict['quantita'])
+                else:
+                    doppione = conn.execute(
+                        select(wardrobe_table.c.id).where(
+                            filtro, wardrobe_table.c.id != capo_id,
+                            *stesso_capo(wardrobe_table, nuovo)
+                        ).limit(1)
+                    ).scalar()
+                    if doppione is None:
+                        conn.execute(
+                            wardrobe_table.update()
+                            .where(filtro, wardrobe_table.c.id == capo_id)
+                            .values(**values, quantita=quantita)
+                        )
+                    else:
+                        # uguale a un capo già presente: i pezzi confluiscono lì
+                        conn.execute(
+                            wardrobe_table.update()
+                            .where(wardrobe_table.c.id == doppione)
+                            .values(quantita=wardrobe_table.c.quantita + quantita)
+                        )
+                        conn.execute(
+                            wardrobe_table.delete().where(filtro, wardrobe_table.c.id == capo_id)
+                        )
+                    aggiorna_catalogo(conn, capo_dict, -capo_dict['quantita'])
+                    aggiorna_catalogo(conn, nuovo, quantita)
+                    sposta_prenotazioni(conn, chiave_catalogo(capo_dict), chiave_catalogo(nuovo))
+                aggiorna_ultimo_inserimento(conn, w)
+                controlla_prenotazioni(conn)
+            cache_header.invalida(user_id)
 
             flash("Capo modificato correttamente.", "success")
             return redirect(url_for('private_wardrobe'))
 
+        except PrenotazioniScoperte as e:
+            flash(e.messaggio(), "error")
+            return redirect(url_for('modifica_capo_wardrobe', nome_tabella=nome_tabella, capo_id=capo_id))
         except Exception as e:
             print("Errore modifica_capo_wardrobe:", e)
             flash("Errore durante la modifica del capo.", "error")
@@ -838,42 +3781,98 @@ def modifica_capo_wardrobe(nome_tabella, capo_id):
 @login_required
 def elimina_capo_wardrobe(nome_tabella, capo_id):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
-    wardrobe_table = Table(nome_tabella, metadata, autoload_with=engine)
     try:
+        wardrobe_table, filtro = tabella_capi(w)
+        dove = (filtro, wardrobe_table.c.id == capo_id)
         with engine.begin() as conn:
-            conn.execute(wardrobe_table.delete().where(wardrobe_table.c.id == capo_id))
+            rimuovi_dal_catalogo(conn, wardrobe_table, *dove)
+            conn.execute(wardrobe_table.delete().where(*dove))
+            aggiorna_ultimo_inserimento(conn, w)
+            controlla_prenotazioni(conn)
+        cache_header.invalida(user_id)
         flash("Capo eliminato.", "success")
+    except PrenotazioniScoperte as e:
+        flash(e.messaggio(), "error")
     except Exception as e:
         print("Errore elimina_capo_wardrobe:", e)
         flash("Errore durante l'eliminazione del capo.", "error")
     return redirect(url_for('private_wardrobe'))
 
 
+@app.route('/quantita-capo-wardrobe/<nome_tabella>/<int:capo_id>', methods=['POST'])
+@login_required
+def quantita_capo_wardrobe(nome_tabella, capo_id):
+    """Aggiunge (delta=1) o toglie (delta=-1) un pezzo di un capo."""
+    user_id = session['user_id']
+    w = wardrobe_utente(nome_tabella)
+    if not w:
+        flash("Non hai accesso a questo wardrobe.", "error")
+        return redirect(url_for('private_wardrobe'))
+
+    delta = request.form.get('delta', type=int)
+    if delta not in (1, -1):
+        flash("Operazione non valida.", "error")
+        return redirect(url_for('private_wardrobe'))
+
+    try:
+        wardrobe_table, filtro = tabella_capi(w)
+        with engine.begin() as conn:
+            if delta > 0:
+                riga = conn.execute(
+                    wardrobe_table.update()
+                    .where(filtro, wardrobe_table.c.id == capo_id)
+                    .values(quantita=wardrobe_table.c.quantita + 1)
+                    .returning(*[wardrobe_table.c[c] for c in CHIAVE_CATALOGO])
+                ).first()
+                if riga:
+                    aggiorna_catalogo(conn, dict(riga._mapping), 1)
+            else:
+                togli_pezzi(conn, w, capo_id, 1)
+            aggiorna_ultimo_inserimento(conn, w)
+            controlla_prenotazioni(conn)
+        cache_header.invalida(user_id)
+    except PrenotazioniScoperte as e:
+        flash(e.messaggio(), "error")
+    except Exception as e:
+        print("Errore quantita_capo_wardrobe:", e)
+        flash("Errore durante l'aggiornamento della quantità.", "error")
+    return redirect(url_for('private_wardrobe'))
+
+
 @app.route('/elimina-wardrobe/<nome_tabella>', methods=['POST'])
 @login_required
 def elimina_wardrobe(nome_tabella):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
     try:
-        wardrobe_table = Table(nome_tabella, metadata, autoload_with=engine)
-        wardrobe_table.drop(engine, checkfirst=True)
+        wardrobe_table, filtro = tabella_capi(w)
+        with engine.begin() as conn:
+            rimuovi_dal_catalogo(conn, wardrobe_table, filtro)
+            if STORAGE_CONDIVISO:
+                conn.execute(wardrobe_table.delete().where(filtro))
+            controlla_prenotazioni(conn)
+        if not STORAGE_CONDIVISO:
+            wardrobe_table.drop(engine, checkfirst=True)
+            invalida_tabella(nome_tabella)
 
         with engine.begin() as conn:
-            wardrobes_table = Table('wardrobes', metadata, autoload_with=engine)
+            wardrobes_table = Wardrobe.__table__
             conn.execute(wardrobes_table.delete().where(wardrobes_table.c.nome == nome_tabella))
+        cache_header.invalida(user_id)
+        invalida_identita(user_id)
 
         flash("Wardrobe eliminato.", "success")
+    except PrenotazioniScoperte as e:
+        flash(e.messaggio(), "error")
     except Exception as e:
         print("Errore elimina_wardrobe:", e)
         flash("Errore durante l'eliminazione del wardrobe.", "error")
@@ -885,33 +3884,31 @@ def elimina_wardrobe(nome_tabella):
 @login_required
 def visualizza_private_wardrobe(nome_tabella):
     user_id = session['user_id']
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
-    wardrobe_table = Table(nome_tabella, metadata, autoload_with=engine)
+    # opzioni per i filtri dal form_data
+    data = tassonomia.get()
+
+    etag, non_modificata = etag_pagina(
+        'visualizza_private_wardrobe', w.id, versione_wardrobe(w),
+        tassonomia.versione, sorted(immagini_in_lavorazione())
+    )
+    if non_modificata:
+        return non_modificata
+
+    wardrobe_table, filtro = tabella_capi(w)
 
     with engine.connect() as conn:
-        rows = conn.execute(wardrobe_table.select()).fetchall()
+        rows = conn.execute(
+            wardrobe_table.select().where(filtro).order_by(wardrobe_table.c.id)
+        ).fetchall()
         columns = wardrobe_table.columns.keys()
         capi = [dict(zip(columns, row)) for row in rows]
 
-    # carico le opzioni per i filtri dal form_data
-    try:
-        with open(os.path.join(BASE_DIR, 'static', 'data', 'form_data.json'), encoding='utf-8') as f:
-            data = json.load(f)
-    except Exception as e:
-        print("Errore lettura form_data.json visualizza:", e)
-        data = {
-            'tipologie': [],
-            'taglie': [],
-            'colori': [],
-            'brands': []
-        }
-
-    return render_template(
+    return con_etag(render_template(
         'visualizza_private_wardrobe.html',
         capi=capi,
         nome_tabella=nome_tabella,
@@ -919,75 +3916,446 @@ def visualizza_private_wardrobe(nome_tabella):
         taglie=data.get('taglie', []),
         colori=data.get('colori', []),
         brands=data.get('brands', [])
-    )
+    ), etag)
 
 
 # ----------------------------
 #       EXPORT DATI GUARDAROBA
 # ----------------------------
 
+# colonne dell'export (stesse per CSV, XLSX e Parquet)
+COLONNE_EXPORT = (
+    "wardrobe_name",
+    "capo_id",
+    "categoria",
+    "tipologia",
+    "taglia",
+    "fit",
+    "colore",
+    "brand",
+    "destinazione",
+    "immagine",
+    "immagine2",
+    "quantita",
+)
+# righe lette dal DB per volta (e righe per row group nel Parquet)
+PAGINA_EXPORT = 1000
+# dimensione dei pezzi inviati al client
+BLOCCO_EXPORT = 64 * 1024
+
+FORMATI_EXPORT = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def _pagine_export(wardrobes):
+    """
+    Righe da esportare (liste nell'ordine di COLONNE_EXPORT) a blocchi di
+    PAGINA_EXPORT, lette con un cursore lato server: in memoria c'è sempre
+    al più una pagina. `wardrobes` è una lista di (nome, tabella, filtro).
+    """
+    for nome, tbl, filtro in wardrobes:
+        cols = [tbl.c.id] + [
+            tbl.c[c] if c in tbl.c else null().label(c)
+            for c in COLONNE_EXPORT[2:]
+        ]
+        with engine.connect() as conn:
+            result = conn.execution_options(
+                stream_results=True, yield_per=PAGINA_EXPORT
+            ).execute(select(*cols).where(filtro).order_by(tbl.c.id))
+            for righe in result.partitions():
+                yield [[nome, *r] for r in righe]
+
+
+def _export_csv(pagine):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+    buf.write('\ufeff')  # BOM per Excel
+    writer.writerow(COLONNE_EXPORT)
+    for righe in pagine:
+        writer.writerows(righe)
+        if buf.tell() >= BLOCCO_EXPORT:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def _export_xlsx(pagine):
+    """
+    L'xlsx è uno zip che si chiude solo alla fine: lo scrivo in un file
+    temporaneo in modalità constant_memory (righe scaricate su disco man
+    mano) e poi lo invio a pezzi.
+    """
+    with tempfile.TemporaryFile() as tmp:
+        wb = xlsxwriter.Workbook(tmp, {'constant_memory': True, 'in_memory': False})
+        ws = wb.add_worksheet('capi')
+        ws.write_row(0, 0, COLONNE_EXPORT)
+        n = 1
+        for righe in pagine:
+            for r in righe:
+                ws.write_row(n, 0, r)
+                n += 1
+        wb.close()
+
+        tmp.seek(0)
+        while True:
+            blocco = tmp.read(BLOCCO_EXPORT)
+            if not blocco:
+                break
+            yield blocco
+
+
+class _CodaByte(io.RawIOBase):
+    """File solo-scrittura che accumula i byte finché non vengono svuotati."""
+
+    def __init__(self):
+        self._blocchi = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._blocchi.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def svuota(self) -> bytes:
+        dati = b''.join(self._blocchi)
+        self._blocchi = []
+        return dati
+
+
+def _export_parquet(pagine):
+    """Un row group per pagina, inviato appena scritto."""
+    schema = pa.schema(
+        [(c, pa.int64() if c in ('capo_id', 'quantita') else pa.string()) for c in COLONNE_EXPORT]
+    )
+    coda = _CodaByte()
+    writer = pq.ParquetWriter(coda, schema)
+    try:
+        for righe in pagine:
+            colonne = list(zip(*righe))
+            writer.write_table(pa.table(
+                [pa.array(v, type=schema.field(i).type) for i, v in enumerate(colonne)],
+                schema=schema
+            ))
+            dati = coda.svuota()
+            if dati:
+                yield dati
+    finally:
+        writer.close()
+    yield coda.svuota()
+
+
+def risposta_export(wardrobes, formato: str, nome_file: str):
+    """Response in streaming dell'export di `wardrobes` nel formato richiesto."""
+    mimetype, estensione = FORMATI_EXPORT[formato]
+    genera = {'csv': _export_csv, 'xlsx': _export_xlsx, 'parquet': _export_parquet}[formato]
+    return Response(
+        stream_with_context(genera(_pagine_export(wardrobes))),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={nome_file}.{estensione}"}
+    )
+
+
+def _formato_export():
+    """Formato richiesto (?formato=csv|xlsx|parquet) oppure None se non disponibile."""
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in FORMATI_EXPORT:
+        return None
+    if formato == 'xlsx' and xlsxwriter is None:
+        return None
+    if formato == 'parquet' and pq is None:
+        return None
+    return formato
+
+
 @app.route('/export-wardrobe/<nome_tabella>')
 @login_required
 def export_wardrobe(nome_tabella):
     user_id = session['user_id']
 
-    w = db_session.query(Wardrobe).filter_by(nome=nome_tabella, user_id=user_id).first()
+    w = wardrobe_utente(nome_tabella)
     if not w:
         flash("Non hai accesso a questo wardrobe.", "error")
         return redirect(url_for('private_wardrobe'))
 
-    metadata = MetaData()
-    wardrobe_table = Table(w.nome, metadata, autoload_with=engine)
-
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-
-    writer.writerow([
-        "wardrobe_name",
-        "capo_id",
-        "categoria",
-        "tipologia",
-        "taglia",
-        "fit",
-        "colore",
-        "brand",
-        "destinazione",
-        "immagine",
-        "immagine2",
-    ])
+    formato = _formato_export()
+    if not formato:
+        flash("Formato di export non disponibile.", "error")
+        return redirect(url_for('visualizza_private_wardrobe', nome_tabella=nome_tabella))
+
+    return risposta_export([(w.nome, *tabella_capi(w))], formato, f"{w.nome}_stycly")
+
+
+@app.route('/export-wardrobes')
+@login_required
+def export_tutti_wardrobe():
+    """Export di tutti i wardrobe dell'utente in un unico file."""
+    user_id = session['user_id']
+
+    formato = _formato_export()
+    if not formato:
+        flash("Formato di export non disponibile.", "error")
+        return redirect(url_for('private_wardrobe'))
+
+    wardrobes = []
+    for w in identita_corrente().wardrobes.values():
+        try:
+            wardrobes.append((w.nome, *tabella_capi(w)))
+        except NoSuchTableError:
+            continue
+
+    username = session.get('username') or f"utente_{user_id}"
+    return risposta_export(wardrobes, formato, f"{secure_filename(username)}_stycly")
 
+
+
+# ----------------------------
+#       IMPORT CAPI (CSV / ZIP)
+# ----------------------------
+
+# campi obbligatori di ogni riga importata (oltre a `immagine`)
+CAMPI_IMPORT = ('categoria', 'tipologia', 'brand', 'destinazione', 'taglia', 'fit', 'colore')
+# righe (capi distinti) scritte per transazione
+LOTTO_IMPORT = 500
+# pezzi massimi per riga (colonna `quantita`)
+MAX_QUANTITA_IMPORT = 1000
+# dimensione massima del file caricato dalla route (uno ZIP con le foto)
+MAX_IMPORT_BYTES = int(os.environ.get("MAX_IMPORT_MB", "200")) * 1024 * 1024
+
+
+class _ImmaginiImport:
+    """
+    Risolve i nomi della colonna `immagine` di un import: prima tra i file
+    dello ZIP (salvati una volta sola con salva_upload), poi tra le
+    immagini già presenti in immagini/.
+    """
+
+    def __init__(self, zf=None):
+        self.zf = zf
+        self._membri = {}
+        self._salvate = {}
+        if zf is not None:
+            for info in zf.infolist():
+                if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                    continue
+                self._membri.setdefault(info.filename, info)
+                self._membri.setdefault(os.path.basename(info.filename), info)
+
+    def risolvi(self, nome: str) -> str:
+        """Nome da salvare nel capo; ValueError se l'immagine non è utilizzabile."""
+        if nome in self._salvate:
+            return self._salvate[nome]
+
+        info = self._membri.get(nome) or self._membri.get(os.path.basename(nome))
+        base = os.path.basename(info.filename if info else nome)
+        if not allowed_file(base):
+            raise ValueError(f"formato immagine non valido: {nome}")
+
+        if info is not None:
+            if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                raise ValueError(f"immagine troppo grande: {nome}")
+            with self.zf.open(info) as f:
+                salvata = salva_upload(FileStorage(stream=f, filename=base))
+        else:
+            salvata = secure_filename(base)
+            # come in salva_upload: prima usato_at (per il GC), poi il file
+            reg = ImmagineFile.__table__
+            with engine.begin() as conn:
+                conn.execute(reg.update().where(reg.c.nome == salvata).values(
+                    usato_at=datetime.now(timezone.utc).isoformat()
+                ))
+            if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], salvata)):
+                raise ValueError(f"immagine non trovata: {nome}")
+
+        self._salvate[nome] = salvata
+        return salvata
+
+
+def _apri_csv_import(nome_file: str, stream):
+    """(testo del CSV, risolutore immagini) da un .csv o da uno .zip con CSV e foto."""
+    if nome_file.lower().endswith('.zip'):
+        try:
+            zf = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            raise ValueError("File ZIP non valido.")
+        csv_info = next(
+            (i for i in zf.infolist()
+             if i.filename.lower().endswith('.csv') and not i.filename.startswith('__MACOSX/')),
+            None
+        )
+        if csv_info is None:
+            raise ValueError("Nessun file CSV nello ZIP.")
+        raw = zf.open(csv_info)
+        immagini = _ImmaginiImport(zf)
+    else:
+        raw = stream
+        immagini = _ImmaginiImport()
+
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''), immagini
+
+
+def _scrivi_lotto_import(w, tbl, filtro, lotto, esistenti: dict) -> None:
+    """
+    Un lotto di (capo, pezzi) in una transazione: i capi già presenti nel
+    wardrobe (`esistenti`: chiave -> id) vengono incrementati, i nuovi
+    inseriti con un solo executemany; poi un aggiornamento catalogo per capo.
+    `esistenti` viene aggiornato con gli id delle righe inserite.
+    """
+    gruppi = {}
+    for capo, n in lotto:
+        chiave = chiave_catalogo(capo)
+        if chiave in gruppi:
+            gruppi[chiave][1] += n
+        else:
+            gruppi[chiave] = [capo, n]
+
+    with engine.begin() as conn:
+        nuovi = []
+        for chiave, (capo, n) in gruppi.items():
+            if chiave in esistenti:
+                values = {'quantita': tbl.c.quantita + n}
+                if capo.get('created_at'):
+                    values['created_at'] = capo['created_at']
+                conn.execute(tbl.update().where(tbl.c.id == esistenti[chiave]).values(**values))
+            else:
+                nuovi.append(valori_capo(w, {**capo, 'quantita': n}))
+
+        if nuovi:
+            ultimo_id = conn.execute(select(func.max(tbl.c.id))).scalar() or 0
+            conn.execute(tbl.insert(), nuovi)
+            cols = [tbl.c[c] for c in CHIAVE_CATALOGO]
+            for r in conn.execute(select(tbl.c.id, *cols).where(filtro, tbl.c.id > ultimo_id)):
+                esistenti.setdefault(chiave_catalogo(r._mapping), r.id)
+
+        for capo, n in gruppi.values():
+            aggiorna_catalogo(conn, capo, n)
+        aggiorna_ultimo_inserimento(conn, w)
+
+
+def importa_capi(w: Wardrobe, nome_file: str, stream, lotto: int = LOTTO_IMPORT) -> dict:
+    """
+    Importa nel wardrobe `w` i capi di un CSV (colonne come guardaroba.csv,
+    separatore `,` o `;`, colonne facoltative `immagine2` e `quantita`) o di
+    uno ZIP con il CSV e le foto. Le righe non valide vengono scartate e
+    riportate; le altre sono scritte a lotti di `lotto` righe.
+    Ritorna {'righe': righe importate, 'inseriti': pezzi inseriti, 'errori': [(riga, messaggio)]}.
+    """
+    testo, immagini = _apri_csv_import(nome_file, stream)
+
+    intestazione = testo.readline()
+    separatore = ';' if intestazione.count(';') > intestazione.count(',') else ','
+    colonne = [c.strip().lower() for c in next(csv.reader([intestazione], delimiter=separatore), [])]
+    mancanti = [c for c in CAMPI_IMPORT + ('immagine',) if c not in colonne]
+    if mancanti:
+        raise ValueError(f"Colonne mancanti nel CSV: {', '.join(mancanti)}.")
+
+    tbl, filtro = tabella_capi(w)
+    report = {'righe': 0, 'inseriti': 0, 'errori': []}
+    in_attesa = []   # (numero riga, capo, pezzi) non ancora scritti
+
+    # capi già nel wardrobe: chiave -> id (per incrementarli invece di duplicarli)
+    cols = [tbl.c[c] for c in CHIAVE_CATALOGO]
     with engine.connect() as conn:
-        rows = conn.execute(wardrobe_table.select()).fetchall()
-        columns = wardrobe_table.columns.keys()
+        esistenti = {
+            chiave_catalogo(r._mapping): r.id
+            for r in conn.execute(select(tbl.c.id, *cols).where(filtro).order_by(tbl.c.id.desc()))
+        }
 
-        for row in rows:
-            row_dict = dict(zip(columns, row))
-            writer.writerow([
-                w.nome,
-                row_dict.get('id'),
-                row_dict.get('categoria'),
-                row_dict.get('tipologia'),
-                row_dict.get('taglia'),
-                row_dict.get('fit'),
-                row_dict.get('colore'),
-                row_dict.get('brand'),
-                row_dict.get('destinazione'),
-                row_dict.get('immagine'),
-                row_dict.get('immagine2'),
-            ])
+    def scrivi():
+        try:
+            _scrivi_lotto_import(w, tbl, filtro, [(c, n) for _, c, n in in_attesa], esistenti)
+            report['righe'] += len(in_attesa)
+            report['inseriti'] += sum(n for _, _, n in in_attesa)
+        except Exception as e:
+            print("Errore import lotto:", e)
+            report['errori'].extend((n, "errore di scrittura nel database") for n, _, _ in in_attesa)
+        in_attesa.clear()
+
+    reader = csv.reader(testo, delimiter=separatore)
+    for numero, valori in enumerate(reader, start=2):
+        if not any(v.strip() for v in valori):
+            continue
+        valori += [''] * (len(colonne) - len(valori))
+        riga = {c: v.strip() for c, v in zip(colonne, valori)}
+
+        try:
+            capo = {c: riga[c] for c in CAMPI_IMPORT}
+            vuoti = [c for c in CAMPI_IMPORT + ('immagine',) if not riga.get(c)]
+            if vuoti:
+                raise ValueError(f"campi vuoti: {', '.join(vuoti)}")
+            errori = tassonomia.errori(capo)
+            if errori:
+                raise ValueError(f"valori non validi per: {', '.join(errori)}")
 
-    csv_data = output.getvalue()
-    output.close()
+            try:
+                quantita = int(riga.get('quantita') or 1)
+            except ValueError:
+                raise ValueError("quantita non valida")
+            if not 1 <= quantita <= MAX_QUANTITA_IMPORT:
+                raise ValueError(f"quantita deve essere tra 1 e {MAX_QUANTITA_IMPORT}")
+
+            capo['immagine'] = immagini.risolvi(riga['immagine'])
+            capo['immagine2'] = immagini.risolvi(riga['immagine2']) if riga.get('immagine2') else None
+        except ValueError as e:
+            report['errori'].append((numero, str(e)))
+            continue
 
-    csv_data = '\ufeff' + csv_data  # BOM per Excel
+        if 'created_at' in tbl.c:
+            capo['created_at'] = datetime.now(timezone.utc).isoformat()
+        in_attesa.append((numero, capo, quantita))
+        if len(in_attesa) >= lotto:
+            scrivi()
 
-    filename = f"{w.nome}_stycly.csv"
+    if in_attesa:
+        scrivi()
+    return report
 
-    return Response(
-        csv_data,
-        mimetype="text/csv; charset=utf-8",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+
+@app.route('/importa-capi-wardrobe/<nome_tabella>', methods=['GET', 'POST'])
+@login_required
+def importa_capi_wardrobe(nome_tabella):
+    user_id = session['user_id']
+    w = wardrobe_utente(nome_tabella)
+    if not w:
+        flash("Non hai accesso a questo wardrobe.", "error")
+        return redirect(url_for('private_wardrobe'))
+
+    report = None
+    if request.method == 'POST':
+        # qui si caricano ZIP con le foto: limite più alto del solito
+        request.max_content_length = MAX_IMPORT_BYTES
+        file = request.files.get('file')
+        if not file or not file.filename.lower().endswith(('.csv', '.zip')):
+            flash("Carica un file CSV o ZIP.", "error")
+            return redirect(url_for('importa_capi_wardrobe', nome_tabella=nome_tabella))
+
+        try:
+            report = importa_capi(w, file.filename, file.stream)
+            cache_header.invalida(user_id)
+        except ValueError as e:
+            flash(str(e), "error")
+            return redirect(url_for('importa_capi_wardrobe', nome_tabella=nome_tabella))
+        except Exception as e:
+            print("Errore importa_capi_wardrobe:", e)
+            flash("Si è verificato un errore durante l'import.", "error")
+            return redirect(url_for('importa_capi_wardrobe', nome_tabella=nome_tabella))
+
+        flash(
+            f"{report['inseriti']} capi importati da {report['righe']} righe, "
+            f"{len(report['errori'])} righe scartate.",
+            "success" if not report['errori'] else "error"
+        )
+
+    return render_template('importa_capi_wardrobe.html', nome_tabella=nome_tabella, report=report)
 
 
 
@@ -1044,6 +4412,341 @@ def wipe_all_users_and_wardrobes():
 
         """
 
+# ----------------------------
+#       PULIZIA IMMAGINI
+# ----------------------------
+
+# Le route che eliminano o sostituiscono capi non cancellano i file: la
+# stessa immagine (indirizzata per contenuto) può servire ad altri capi.
+# `flask gc-immagini` conta i riferimenti di ogni immagine del registro e
+# cancella quelle senza riferimenti più vecchie del periodo di grazia (che
+# copre gli upload salvati ma non ancora legati a un capo). I file fuori dal
+# registro (immagini del sito, upload precedenti al registro) non si toccano.
+GRAZIA_GC_ORE = 24
+BATCH_GC = 1000
+
+
+def _riferimenti_wardrobe(w, batch: int):
+    """Nomi delle immagini usate dai capi del wardrobe, letti a blocchi."""
+    try:
+        tbl, filtro = tabella_capi(w)
+    except NoSuchTableError:
+        return
+    cols = [tbl.c[c] for c in ('immagine', 'immagine2') if c in tbl.c]
+    with engine.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=batch
+        ).execute(select(*cols).where(filtro))
+        for righe in result.partitions():
+            for riga in righe:
+                for valore in riga:
+                    if valore:
+                        yield valore.split('/')[-1]
+
+
+def conta_riferimenti_immagini(batch: int = BATCH_GC):
+    """
+    Scorre tutti i wardrobe. Ritorna (riferimenti per immagine, per ogni
+    wardrobe (id, nome, user_id, capi letti, insieme delle immagini)).
+    """
+    riferimenti = {}
+    per_wardrobe = []
+    with engine.connect() as conn:
+        wardrobes = conn.execute(
+            select(Wardrobe.id, Wardrobe.nome, Wardrobe.user_id).order_by(Wardrobe.id)
+        ).fetchall()
+
+    for w in wardrobes:
+        nomi = set()
+        for nome in _riferimenti_wardrobe(w, batch):
+            riferimenti[nome] = riferimenti.get(nome, 0) + 1
+            nomi.add(nome)
+        per_wardrobe.append((w, nomi))
+    return riferimenti, per_wardrobe
+
+
+def _file_immagine(nome: str) -> list[str]:
+    """Percorsi dell'immagine e dei suoi derivati."""
+    cartella = app.config['UPLOAD_FOLDER']
+    stem = os.path.splitext(nome)[0]
+    percorsi = [os.path.join(cartella, nome)]
+    for w in LARGHEZZE_DERIVATI:
+        for fmt in ('jpg', 'webp'):
+            percorsi.append(os.path.join(cartella, CARTELLA_DERIVATI, f"{stem}__w{w}.{fmt}"))
+    return percorsi
+
+
+def _elimina_immagine(r, soglia: str) -> int | None:
+    """
+    Cancella file, derivati e riga del registro dell'immagine `r` se nel
+    frattempo nessuno l'ha riusata (usato_at ancora prima di `soglia`).
+    La riga resta bloccata fino a dopo la rimozione dei file: un upload
+    dello stesso contenuto aspetta e poi riscrive il file (vedi salva_upload).
+    Ritorna i byte liberati, None se l'immagine è stata riusata.
+    """
+    reg = ImmagineFile.__table__
+    liberati = 0
+    with engine.begin() as conn:
+        presa = conn.execute(reg.delete().where(
+            reg.c.id == r.id,
+            or_(reg.c.created_at.is_(None), reg.c.created_at < soglia),
+            or_(reg.c.usato_at.is_(None), reg.c.usato_at < soglia),
+        )).rowcount
+        if not presa:
+            return None
+        for percorso in reversed(_file_immagine(r.nome)):
+            try:
+                liberati += os.path.getsize(percorso)
+                os.remove(percorso)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print("Errore eliminazione immagine:", percorso, e)
+    return liberati
+
+
+def gc_immagini(grazia_ore: float = GRAZIA_GC_ORE, batch: int = BATCH_GC,
+                limite: int | None = None, prova: bool = False) -> dict:
+    """
+    Conta i riferimenti delle immagini del registro (una sola passata su
+    tutti i wardrobe, a blocchi di `batch` righe) e cancella (file, derivati
+    e riga del registro) quelle senza capi, caricate o riusate l'ultima
+    volta più di `grazia_ore` fa. Un capo creato dopo la passata usa un
+    upload con usato_at recente, che la cancellazione condizionata rispetta.
+    Al più `limite` immagini esaminate per esecuzione (prima quelle contate
+    meno di recente): le successive riprendono dalle altre. Con `prova`
+    non scrive nulla.
+    """
+    reg = ImmagineFile.__table__
+    adesso = datetime.now(timezone.utc)
+    soglia = (adesso - timedelta(hours=grazia_ore)).isoformat()
+
+    query = (
+        select(reg.c.id, reg.c.nome, reg.c.dimensione, reg.c.created_at, reg.c.usato_at)
+        # mai contate per prime, poi dalla più vecchia
+        .order_by(reg.c.contati_at.is_not(None), reg.c.contati_at, reg.c.id)
+    )
+    if limite:
+        query = query.limit(limite)
+    with engine.connect() as conn:
+        da_esaminare = conn.execute(query).fetchall()
+
+    risultato = {'esaminate': len(da_esaminare), 'eliminate': 0, 'byte': 0, 'nomi': []}
+    if not da_esaminare:
+        return risultato
+    riferimenti, _ = conta_riferimenti_immagini(batch)
+    for i in range(0, len(da_esaminare), batch):
+        lotto = da_esaminare[i:i + batch]
+        if not prova:
+            with engine.begin() as conn:
+                conn.execute(
+                    reg.update().where(reg.c.id == bindparam('_id')).values(
+                        riferimenti=bindparam('_riferimenti'), contati_at=adesso.isoformat()
+                    ),
+                    [{'_id': r.id, '_riferimenti': riferimenti.get(r.nome, 0)} for r in lotto]
+                )
+
+        for r in lotto:
+            if riferimenti.get(r.nome) or max(r.created_at or '', r.usato_at or '') >= soglia:
+                continue
+            if prova:
+                liberati = r.dimensione or 0
+            else:
+                liberati = _elimina_immagine(r, soglia)
+                if liberati is None:
+                    continue
+            risultato['nomi'].append(r.nome)
+            risultato['eliminate'] += 1
+            risultato['byte'] += liberati
+
+    return risultato
+
+
+def spazio_immagini(batch: int = BATCH_GC) -> dict:
+    """
+    Occupazione delle immagini: per utente (immagini distinte dei suoi
+    wardrobe, un file condiviso conta per ognuno) e totali della cartella.
+    """
+    reg = ImmagineFile.__table__
+    cartella = app.config['UPLOAD_FOLDER']
+    with engine.connect() as conn:
+        dimensioni = dict(conn.execute(select(reg.c.nome, reg.c.dimensione)).fetchall())
+        utenti = dict(conn.execute(select(User.id, User.username)).fetchall())
+
+    def dimensione(nome):
+        if dimensioni.get(nome) is not None:
+            return dimensioni[nome]
+        try:
+            return os.path.getsize(os.path.join(cartella, nome))
+        except OSError:
+            return 0
+
+    riferimenti, per_wardrobe = conta_riferimenti_immagini(batch)
+    per_utente = {}
+    for w, nomi in per_wardrobe:
+        voce = per_utente.setdefault(w.user_id, {'utente': utenti.get(w.user_id, '?'), 'immagini': set()})
+        voce['immagini'] |= nomi
+    righe = sorted(
+        ({'utente': v['utente'], 'immagini': len(v['immagini']),
+          'byte': sum(dimensione(n) for n in v['immagini'])} for v in per_utente.values()),
+        key=lambda r: r['byte'], reverse=True
+    )
+
+    totali = {'registrate': 0, 'orfane': 0, 'non_registrate': 0, 'derivati': 0}
+    byte = dict.fromkeys(totali, 0)
+    for voce in os.scandir(cartella) if os.path.isdir(cartella) else ():
+        if voce.is_file():
+            chiave = 'non_registrate'
+            if voce.name in dimensioni:
+                chiave = 'registrate' if riferimenti.get(voce.name) else 'orfane'
+            totali[chiave] += 1
+            byte[chiave] += voce.stat().st_size
+    derivati = os.path.join(cartella, CARTELLA_DERIVATI)
+    for voce in os.scandir(derivati) if os.path.isdir(derivati) else ():
+        totali['derivati'] += 1
+        byte['derivati'] += voce.stat().st_size
+
+    return {'utenti': righe, 'file': totali, 'byte': byte}
+
+
+# ----------------------------
+#       COMANDI CLI
+# ----------------------------
+
+db_cli = AppGroup('db', help="Migrazioni dello schema del database.")
+
+
+@db_cli.command('upgrade')
+def db_upgrade_command():
+    """Applica le migrazioni mancanti (un processo alla volta)."""
+    applicate = aggiorna_schema(verbose=True)
+    if applicate:
+        print(f"Schema aggiornato alla versione {applicate[-1]}.")
+    else:
+        print(f"Schema già alla versione {versione_schema()}.")
+
+
+@db_cli.command('current')
+def db_current_command():
+    """Mostra la versione dello schema del DB e quella attesa dal codice."""
+    print(f"DB alla versione {versione_schema()}, codice alla {VERSIONE_SCHEMA}.")
+
+
+app.cli.add_command(db_cli)
+
+
+@app.cli.command('migra-capi')
+@click.option('--batch', default=500, show_default=True, help="Righe copiate per transazione.")
+def migra_capi_command(batch):
+    """Copia i capi dalle tabelle per utente alla tabella unica `capi`."""
+    n = migra_capi_condivisi(batch)
+    print(f"Migrazione completata: {n} righe scritte.")
+    if not STORAGE_CONDIVISO:
+        print("Imposta WARDROBE_STORAGE=condiviso e riavvia per usare la tabella unica.")
+
+
+@app.cli.command('compatta-capi')
+@click.option('--batch', default=500, show_default=True, help="Gruppi fusi per transazione.")
+def compatta_capi_command(batch):
+    """Fonde i capi duplicati (un pezzo per riga) in una riga con la quantita."""
+    n = compatta_capi(batch)
+    print(f"Compattazione completata: {n} righe duplicate eliminate.")
+
+
+@app.cli.command('genera-derivati')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help="Processi in parallelo.")
+@click.option('--forza', is_flag=True, help="Rigenera anche i derivati già presenti.")
+def genera_derivati_command(workers, forza):
+    """Genera thumbnail e WebP per tutte le immagini già caricate."""
+    cartella = app.config['UPLOAD_FOLDER']
+    nomi = [
+        n for n in sorted(os.listdir(cartella))
+        if os.path.isfile(os.path.join(cartella, n)) and allowed_file(n)
+    ]
+
+    creati = errori = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(genera_derivati, cartella, n, forza): n for n in nomi}
+        for fut, nome in futures.items():
+            try:
+                creati += len(fut.result())
+            except Exception as e:
+                errori += 1
+                print("Errore derivati:", nome, e)
+
+    print(f"{len(nomi)} immagini elaborate, {creati} derivati creati, {errori} errori.")
+
+
+@app.cli.command('gc-immagini')
+@click.option('--grazia-ore', default=GRAZIA_GC_ORE, show_default=True, help="Età minima di un'immagine orfana da cancellare.")
+@click.option('--batch', default=BATCH_GC, show_default=True, help="Righe lette per blocco.")
+@click.option('--limite', default=0, help="Massimo di immagini esaminate (0 = tutte); le successive esecuzioni riprendono dalle altre.")
+@click.option('--prova', is_flag=True, help="Mostra cosa cancellerebbe senza cancellare.")
+def gc_immagini_command(grazia_ore, batch, limite, prova):
+    """Cancella le immagini caricate che nessun capo usa più."""
+    r = gc_immagini(grazia_ore, batch, limite or None, prova)
+    for nome in r['nomi']:
+        print(("da eliminare: " if prova else "eliminata: ") + nome)
+    verbo = "eliminabili" if prova else "eliminate"
+    print(f"{r['esaminate']} immagini esaminate, {r['eliminate']} {verbo}, "
+          f"{r['byte'] / 1024 / 1024:.1f} MB liberati"
+          f"{' (solo originali)' if prova else ''}.")
+
+
+@app.cli.command('spazio-immagini')
+def spazio_immagini_command():
+    """Spazio occupato dalle immagini, per utente e in totale."""
+    r = spazio_immagini()
+    for u in r['utenti']:
+        print(f"{u['utente']:<30}{u['immagini']:>8} immagini{u['byte'] / 1024 / 1024:>10.1f} MB")
+    for chiave, n in r['file'].items():
+        print(f"{chiave.replace('_', ' '):<30}{n:>8} file   {r['byte'][chiave] / 1024 / 1024:>10.1f} MB")
+
+
+@app.cli.command('worker')
+@click.option('--una-volta', is_flag=True, help="Esegue i lavori in coda ed esce.")
+def worker_command(una_volta):
+    """Esegue i lavori in coda (derivati delle immagini) in questo processo."""
+    n = recupera_lavori_bloccati()
+    if n:
+        print(f"{n} lavori interrotti rimessi in coda.")
+    if una_volta:
+        print(f"{esegui_lavori(fermati_se_vuota=True)} lavori eseguiti.")
+        return
+    print("Worker avviato, in attesa di lavori (Ctrl+C per uscire).")
+    esegui_lavori()
+
+
+@app.cli.command('importa-capi')
+@click.argument('wardrobe')
+@click.argument('percorso', type=click.Path(exists=True, dir_okay=False))
+@click.option('--lotto', default=LOTTO_IMPORT, show_default=True, help="Capi scritti per transazione.")
+def importa_capi_command(wardrobe, percorso, lotto):
+    """Importa i capi di un CSV (o ZIP con CSV e foto) nel wardrobe indicato."""
+    w = db_session.query(Wardrobe).filter_by(nome=wardrobe).first()
+    if not w:
+        raise click.ClickException(f"Wardrobe {wardrobe} non trovato.")
+
+    inizio = time.perf_counter()
+    with open(percorso, 'rb') as f:
+        try:
+            report = importa_capi(w, os.path.basename(percorso), f, lotto)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    for numero, errore in report['errori']:
+        print(f"riga {numero}: {errore}")
+    print(f"{report['inseriti']} capi importati da {report['righe']} righe "
+          f"in {time.perf_counter() - inizio:.1f}s, {len(report['errori'])} righe scartate.")
+
+
+@app.cli.command('ricostruisci-catalogo')
+def ricostruisci_catalogo_command():
+    """Ricostruisce il catalogo pubblico materializzato da tutti i wardrobe."""
+    n = ricostruisci_catalogo()
+    print(f"Catalogo ricostruito: {n} voci.")
+
+
 # ----------------------------
 #       AVVIO LOCALE
 # ----------------------------
@@ -2,7 +2,10 @@
 
 // --- CONFIG ---
 const CART_KEY = 'styclyCart';
+const DATE_KEY = 'styclyCartDate';
 let cart = [];
+// pezzi liberi per id nelle date scelte (null = date non impostate)
+let liberi = null;
 
 // --- STORAGE ---
 function loadCart() {
@@ -18,6 +21,19 @@ function saveCart() {
   localStorage.setItem(CART_KEY, JSON.stringify(cart));
 }
 
+function loadDate() {
+  try {
+    const saved = JSON.parse(localStorage.getItem(DATE_KEY) || '{}');
+    return { dal: saved.dal || '', al: saved.al || '' };
+  } catch (e) {
+    return { dal: '', al: '' };
+  }
+}
+
+function saveDate(dal, al) {
+  localStorage.setItem(DATE_KEY, JSON.stringify({ dal, al }));
+}
+
 function getTotalItems() {
   return cart.reduce((sum, item) => sum + item.qty, 0);
 }
@@ -46,7 +62,7 @@ function renderCart() {
 
     row.innerHTML = `
       <div class="mini-cart-img">
-        <img src="/immagini/${item.img || ''}" alt="${item.name || ''}">
+        <img src="/immagini/${item.img || ''}?w=320" alt="${item.name || ''}">
 
       </div>
       <div class="mini-cart-info">
@@ -70,6 +86,7 @@ function renderCart() {
                   class="qty-btn qty-plus"
                   data-index="${index}">+</button>
         </div>
+        ${liberiHtml(item)}
       </div>
     `;
 
@@ -79,6 +96,108 @@ function renderCart() {
   totalEl.textContent = getTotalItems();
 }
 
+function liberiHtml(item) {
+  if (!liberi || !(String(item.id) in liberi)) return '';
+  const n = liberi[String(item.id)];
+  if (n >= item.qty) {
+    return `<div class="mini-cart-liberi">Disponibili nelle date: ${n}</div>`;
+  }
+  return `<div class="mini-cart-liberi esaurito">Solo ${n} disponibili nelle date scelte</div>`;
+}
+
+function showCartMessage(text, isError) {
+  const el = document.getElementById('cart-messaggio');
+  if (!el) return;
+  el.textContent = text || '';
+  el.classList.toggle('errore', !!isError);
+}
+
+// --- NOLEGGIO: DISPONIBILITA' E PRENOTAZIONE ---
+let dispSeq = 0;
+
+async function refreshAvailability() {
+  const box = document.querySelector('.cart-date');
+  const dal = document.getElementById('cart-dal');
+  const al = document.getElementById('cart-al');
+  if (!box || !dal || !al) return;
+
+  saveDate(dal.value, al.value);
+  const seq = ++dispSeq;
+  if (!dal.value || !al.value || cart.length === 0) {
+    liberi = null;
+    showCartMessage('');
+    renderCart();
+    return;
+  }
+  const ids = cart.map((i) => i.id).join(',');
+  try {
+    const resp = await fetch(`${box.dataset.apiDisponibilita}?ids=${encodeURIComponent(ids)}` +
+      `&dal=${dal.value}&al=${al.value}`);
+    const data = await resp.json();
+    if (seq !== dispSeq) return; // risposta superata da una più recente
+    if (!resp.ok) {
+      liberi = null;
+      showCartMessage(data.error, true);
+    } else {
+      liberi = data.disponibilita;
+      showCartMessage('');
+    }
+    renderCart();
+  } catch (err) {
+    console.error('Errore disponibilità:', err);
+  }
+}
+
+async function proceedRental() {
+  const box = document.querySelector('.cart-date');
+  const dal = document.getElementById('cart-dal');
+  const al = document.getElementById('cart-al');
+  if (!box || !dal || !al) return;
+
+  if (cart.length === 0) {
+    showCartMessage('Il carrello è vuoto.', true);
+    return;
+  }
+  if (!dal.value || !al.value) {
+    showCartMessage('Scegli le date del noleggio.', true);
+    return;
+  }
+  try {
+    const resp = await fetch(box.dataset.apiPrenotazioni, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        dal: dal.value,
+        al: al.value,
+        items: cart.map((i) => ({ id: i.id, qty: i.qty })),
+      }),
+    });
+    const data = await resp.json();
+    if (resp.status === 401) {
+      window.location.href = '/login';
+      return;
+    }
+    if (resp.status === 409) {
+      liberi = data.disponibilita;
+      renderCart();
+      showCartMessage('Alcuni capi non sono più disponibili nelle date scelte.', true);
+      return;
+    }
+    if (!resp.ok) {
+      showCartMessage(data.error, true);
+      return;
+    }
+    cart = [];
+    liberi = null;
+    saveCart();
+    renderCart();
+    showCartMessage(`Noleggio confermato dal ${data.dal} al ${data.al}.`);
+  } catch (err) {
+    console.error('Errore prenotazione:', err);
+    showCartMessage('Errore di rete, riprova.', true);
+  }
+}
+
 // --- LOGICA CARRELLO ---
 function addToCart(product) {
   if (!product || !product.id) return;
@@ -101,6 +220,7 @@ function addToCart(product) {
 function openCart() {
   const overlay = document.getElementById('cart-overlay');
   if (overlay) overlay.classList.remove('cart-hidden');
+  refreshAvailability();
 }
 
 function closeCart() {
@@ -123,6 +243,23 @@ document.addEventListener('DOMContentLoaded', function () {
   loadCart();
   renderCart();
 
+  // Date del noleggio (ricordate come il carrello)
+  const inputDal = document.getElementById('cart-dal');
+  const inputAl = document.getElementById('cart-al');
+  if (inputDal && inputAl) {
+    const oggi = new Date().toISOString().slice(0, 10);
+    const saved = loadDate();
+    inputDal.min = oggi;
+    inputAl.min = oggi;
+    inputDal.value = saved.dal >= oggi ? saved.dal : '';
+    inputAl.value = saved.al >= oggi ? saved.al : '';
+    inputDal.addEventListener('change', () => {
+      if (inputDal.value) inputAl.min = inputDal.value;
+      refreshAvailability();
+    });
+    inputAl.addEventListener('change', refreshAvailability);
+  }
+
   window.styclyAddToCart = addToCart;
   window.styclyOpenCart = openCart;
   // Click su "aggiungi al carrello" (products.html, ecc.)
@@ -202,7 +339,7 @@ document.addEventListener('DOMContentLoaded', function () {
       if (typeof window.styclyProceedOrder === 'function') {
         window.styclyProceedOrder(cart);
       } else {
-        alert('Procedi con l’ordine: collega qui il flusso di checkout.');
+        proceedRental();
       }
     });
   }
@@ -224,4 +361,49 @@ document.addEventListener('DOMContentLoaded', function () {
       if (e.target === searchOverlay) closeSearch();
     });
   }
+
+  // Risultati mentre si digita (Invio apre la pagina /search completa)
+  const searchInput = searchOverlay ? searchOverlay.querySelector('.search-input') : null;
+  const searchResults = searchOverlay ? searchOverlay.querySelector('.search-results') : null;
+  let searchTimer = null;
+  let searchSeq = 0;
+
+  if (searchInput && searchResults && searchInput.dataset.api) {
+    searchInput.addEventListener('input', () => {
+      clearTimeout(searchTimer);
+      searchTimer = setTimeout(async () => {
+        const q = searchInput.value.trim();
+        const seq = ++searchSeq;
+        if (!q) {
+          searchResults.innerHTML = '';
+          return;
+        }
+        try {
+          const resp = await fetch(`${searchInput.dataset.api}?limit=8&q=${encodeURIComponent(q)}`);
+          const data = await resp.json();
+          if (seq !== searchSeq) return; // risposta superata da una più recente
+          searchResults.innerHTML = '';
+          data.items.forEach(capo => {
+            const li = document.createElement('li');
+            const a = document.createElement('a');
+            a.href = `${searchInput.form.action}?q=${encodeURIComponent(q)}`;
+            if (capo.immagine) {
+              const img = document.createElement('img');
+              img.src = `/immagini/${encodeURIComponent(capo.immagine)}?w=320`;
+              img.alt = '';
+              a.appendChild(img);
+            }
+            const span = document.createElement('span');
+            span.textContent = [capo.tipologia, capo.brand, capo.colore, capo.taglia]
+              .filter(Boolean).join(' · ');
+            a.appendChild(span);
+            li.appendChild(a);
+            searchResults.appendChild(li);
+          });
+        } catch (err) {
+          console.error('Errore ricerca:', err);
+        }
+      }, 200);
+    });
+  }
 });
@@ -251,3 +251,161 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
 
+
+/* =====================================================
+   CATALOGO – FILTRI LATO SERVER + SCROLL INFINITO
+===================================================== */
+
+document.addEventListener('DOMContentLoaded', () => {
+  const grid = document.getElementById('catalog-grid');
+  if (!grid || !grid.dataset.api) return;
+
+  const sentinel = document.getElementById('catalog-sentinel');
+  const emptyEl = document.getElementById('catalog-empty');
+  const countEl = document.getElementById('item-count');
+  const filterSelects = document.querySelectorAll('.filter-select');
+
+  let nextCursor = grid.dataset.nextCursor || '';
+  let loading = false;
+  let generation = 0; // scarta le risposte arrivate dopo un cambio filtri
+
+  function currentFilters() {
+    const params = new URLSearchParams();
+    filterSelects.forEach(select => {
+      if (select.value) params.set(select.dataset.filter, select.value);
+    });
+    return params;
+  }
+
+  function buildImg(url, srcset, alt) {
+    const img = document.createElement('img');
+    img.src = url;
+    if (srcset) {
+      img.srcset = srcset;
+      img.sizes = '(max-width: 768px) 100vw, 33vw';
+    }
+    img.alt = alt;
+    img.className = 'capo-img';
+    img.loading = 'lazy';
+    return img;
+  }
+
+  // stessa struttura delle card renderizzate da index.html
+  function buildCard(capo) {
+    const card = document.createElement('div');
+    card.className = 'capo-flip-card';
+    card.setAttribute('data-capo', JSON.stringify(capo));
+
+    const inner = document.createElement('div');
+    inner.className = 'capo-flip-inner';
+
+    const front = document.createElement('div');
+    front.className = 'capo-flip-front';
+    if (capo.url_immagine) front.appendChild(buildImg(capo.url_immagine, capo.srcset_immagine, 'fronte'));
+
+    const back = document.createElement('div');
+    back.className = 'capo-flip-back';
+    if (capo.url_immagine2) {
+      back.appendChild(buildImg(capo.url_immagine2, capo.srcset_immagine2, 'retro'));
+    } else {
+      const p = document.createElement('p');
+      p.style.textAlign = 'center';
+      p.style.fontSize = '0.8rem';
+      p.textContent = 'Nessuna retro immagine';
+      back.appendChild(p);
+    }
+
+    inner.appendChild(front);
+    inner.appendChild(back);
+    card.appendChild(inner);
+    return card;
+  }
+
+  // riscrive le opzioni delle tendine con i conteggi per i filtri correnti
+  async function refreshFacets(params, myGeneration) {
+    if (!grid.dataset.facets) return;
+    try {
+      const resp = await fetch(`${grid.dataset.facets}?${params.toString()}`, {
+        headers: { 'Accept': 'application/json' }
+      });
+      if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+      const data = await resp.json();
+      if (myGeneration !== generation) return;
+
+      filterSelects.forEach(select => {
+        const counts = (data.facette || {})[select.dataset.filter];
+        if (!counts) return;
+        const selected = select.value;
+        const first = select.options[0];
+        select.innerHTML = '';
+        select.appendChild(first);
+        Object.entries(counts).forEach(([value, n]) => {
+          const opt = document.createElement('option');
+          opt.value = value;
+          opt.textContent = `${value} (${n})`;
+          select.appendChild(opt);
+        });
+        select.value = selected;
+      });
+    } catch (err) {
+      console.error('Errore conteggi filtri:', err);
+    }
+  }
+
+  function updateCount(total) {
+    if (countEl) countEl.textContent = `${total} cap${total === 1 ? 'o' : 'i'} trovati`;
+    if (emptyEl) emptyEl.hidden = total > 0;
+  }
+
+  async function loadPage(reset) {
+    if (loading && !reset) return;
+    if (!reset && !nextCursor) return;
+
+    const myGeneration = reset ? ++generation : generation;
+    const params = currentFilters();
+    if (!reset) params.set('cursor', nextCursor);
+
+    loading = true;
+    try {
+      const resp = await fetch(`${grid.dataset.api}?${params.toString()}`, {
+        headers: { 'Accept': 'application/json' }
+      });
+      if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+      const data = await resp.json();
+      if (myGeneration !== generation) return;
+
+      if (reset) grid.innerHTML = '';
+      data.items.forEach(capo => grid.appendChild(buildCard(capo)));
+      nextCursor = data.next_cursor || '';
+      if (typeof data.totale === 'number') updateCount(data.totale);
+    } catch (err) {
+      console.error('Errore caricamento catalogo:', err);
+    } finally {
+      if (myGeneration === generation) loading = false;
+    }
+
+    // se la pagina non riempie lo schermo carico subito la successiva
+    if (nextCursor && sentinel && sentinel.getBoundingClientRect().top < window.innerHeight) {
+      loadPage(false);
+    }
+  }
+
+  function applyFilters() {
+    loadPage(true);
+    refreshFacets(currentFilters(), generation);
+  }
+
+  filterSelects.forEach(select => select.addEventListener('change', applyFilters));
+
+  window.resetFilters = function () {
+    filterSelects.forEach(select => { select.value = ''; });
+    applyFilters();
+  };
+
+  if (sentinel && 'IntersectionObserver' in window) {
+    const observer = new IntersectionObserver(entries => {
+      if (entries.some(entry => entry.isIntersecting)) loadPage(false);
+    }, { rootMargin: '600px 0px' });
+    observer.observe(sentinel);
+  }
+});